@@ -6,11 +6,17 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from ._method import collapse, filter_table, filter_seqs
+from ._method import (collapse, collapse_batch, collapse_incremental,
+                      collapse_levels, collapse_merge, collapse_plan,
+                      collapse_presence_absence, collapse_streaming,
+                      collapse_with_plan, filter_table, filter_seqs)
 from ._visualizer import barplot
 from ._version import get_versions
 
 __version__ = get_versions()['version']
 del get_versions
 
-__all__ = ['barplot', 'collapse', 'filter_table', 'filter_seqs']
+__all__ = ['barplot', 'collapse', 'collapse_batch', 'collapse_incremental',
+           'collapse_levels', 'collapse_merge', 'collapse_plan',
+           'collapse_presence_absence', 'collapse_streaming',
+           'collapse_with_plan', 'filter_table', 'filter_seqs']
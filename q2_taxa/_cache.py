@@ -0,0 +1,353 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import copy
+import hashlib
+import os
+import shutil
+import tempfile
+
+import biom
+import h5py
+import numpy as np
+
+from ._search import LineageSearchIndex
+from ._taxonomy import TaxonomyIndex
+
+# Caching is opt-in: nothing is written to disk unless CACHE_DIR_ENV is set.
+CACHE_DIR_ENV = 'Q2_TAXA_CACHE_DIR'
+CACHE_SIZE_ENV = 'Q2_TAXA_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = 2 ** 30
+MEMORY_CACHE_ENTRIES = 16
+# Looking a taxonomy up in the cache means hashing all of it, which costs
+# more than parsing the lineages of a table whose features are only a small
+# part of that taxonomy.
+MIN_CACHED_FRACTION = 0.05
+
+_INDEX_ARRAYS = ('ids', 'sorted_ids', 'id_order', 'lineage_codes',
+                 'lineages', 'ranks', 'depths', 'vocabulary',
+                 'vocabulary_offsets')
+_SEARCH_ARRAYS = ('trigrams', 'offsets', 'postings')
+
+
+def _cache_dir():
+    return os.environ.get(CACHE_DIR_ENV) or None
+
+
+def _cache_size():
+    return int(os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE))
+
+
+def _update_strings(digest, strings):
+    digest.update('\0'.join(strings).encode('utf8'))
+    digest.update(b'\1')
+
+
+def _update_array(digest, array):
+    array = np.ascontiguousarray(array)
+    digest.update(str(array.dtype).encode('ascii'))
+    digest.update(array.view(np.uint8))
+
+
+def _hash_series(series):
+    # Hashing the joined strings is several times faster than hashing the
+    # series with pandas.
+    digest = hashlib.sha256()
+    _update_strings(digest, series.index.to_numpy(dtype=object))
+    _update_strings(digest, series.to_numpy(dtype=object))
+    return digest.hexdigest()
+
+
+def _hash_table(table):
+    digest = hashlib.sha256()
+    matrix = table.matrix_data
+    for array in (matrix.indptr, matrix.indices, matrix.data):
+        _update_array(digest, array)
+    _update_strings(digest, table.ids(axis='observation'))
+    _update_strings(digest, table.ids(axis='sample'))
+    return digest.hexdigest()
+
+
+def _hash_taxonomy_index(index):
+    digest = hashlib.sha256()
+    _update_strings(digest, index.ids)
+    _update_strings(digest, index.lineages)
+    _update_array(digest, index.lineage_codes)
+    digest.update(str(index.max_level).encode('ascii'))
+    return digest.hexdigest()
+
+
+def _entry_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def _touch(path):
+    # entries are evicted by modification time, so touching an entry marks
+    # it as most recently used.
+    os.utime(path)
+
+
+def _evict(cache_dir, max_size):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        # in-progress entries are hidden until they are committed
+        if entry.is_dir() and not entry.name.startswith('.'):
+            entries.append((entry.stat().st_mtime, _entry_size(entry.path),
+                            entry.path))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def _commit_entry(cache_dir, tmp_path, path):
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    _evict(cache_dir, _cache_size())
+
+
+def _save_taxonomy_index(index, path):
+    vocabulary_offsets = np.cumsum(
+        [0] + [len(e) for e in index.vocabularies])
+    if index.vocabularies:
+        vocabulary = np.concatenate(index.vocabularies)
+    else:
+        vocabulary = np.array([], dtype=object)
+    ids = np.asarray(index.ids, dtype=str)
+    id_order = np.argsort(ids, kind='stable')
+    arrays = {
+        'ids': ids,
+        'sorted_ids': ids[id_order],
+        'id_order': id_order,
+        'lineage_codes': index.lineage_codes,
+        'lineages': np.asarray(index.lineages, dtype=str),
+        'ranks': index.ranks,
+        'depths': index.depths,
+        'vocabulary': np.asarray(vocabulary, dtype=str),
+        'vocabulary_offsets': vocabulary_offsets,
+    }
+    for name in _INDEX_ARRAYS:
+        np.save(os.path.join(path, name + '.npy'),
+                np.ascontiguousarray(arrays[name]))
+
+
+def _load_taxonomy_index(path):
+    arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                            mmap_mode='r')
+              for name in _INDEX_ARRAYS}
+    offsets = arrays['vocabulary_offsets']
+    vocabulary = np.asarray(arrays['vocabulary'], dtype=object)
+    vocabularies = [vocabulary[start:stop]
+                    for start, stop in zip(offsets[:-1], offsets[1:])]
+    # IDs and lineages stay memory-mapped: a few IDs are looked up by binary
+    # search in the sorted copy (see TaxonomyIndex.get_indexer), and only the
+    # lineages of the features that are taken from the index are read.
+    return TaxonomyIndex(
+        arrays['ids'], arrays['lineage_codes'], arrays['lineages'],
+        arrays['ranks'], vocabularies, arrays['depths'],
+        sorted_ids=arrays['sorted_ids'], id_order=arrays['id_order'])
+
+
+def _taxonomy_digest(taxonomy):
+    """Content hash of ``taxonomy``, or None when caching is disabled.
+
+    Computing it once lets the taxonomy and search index caches share it.
+    """
+    if _cache_dir() is None:
+        return None
+    return _hash_series(taxonomy)
+
+
+def _cached_taxonomy_index(taxonomy, digest=None):
+    """Return the compiled TaxonomyIndex of ``taxonomy`` from the cache.
+
+    The index is compiled (and stored) on a cache miss. Cached arrays are
+    memory-mapped rather than read into memory. ``digest`` is the
+    taxonomy's ``_taxonomy_digest``, which is computed when not provided.
+    Returns None when caching is disabled.
+    """
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, 'taxonomy-%s'
+                        % (digest or _hash_series(taxonomy)))
+    if os.path.isdir(path):
+        _touch(path)
+        return _load_taxonomy_index(path)
+
+    index = TaxonomyIndex.from_series(taxonomy)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-taxonomy-', dir=cache_dir)
+    _save_taxonomy_index(index, tmp_path)
+    _commit_entry(cache_dir, tmp_path, path)
+    return index
+
+
+def _cached_search_index(taxonomy, lineages, digest=None):
+    """Return the LineageSearchIndex of ``taxonomy`` from the cache.
+
+    ``lineages`` are the distinct lineages of ``taxonomy``, in the order of
+    its (cached) TaxonomyIndex. The index is built (and stored) on a cache
+    miss, and its arrays are memory-mapped on a hit. ``digest`` is as for
+    ``_cached_taxonomy_index``. Returns None when caching is disabled.
+    """
+    cache_dir = _cache_dir()
+    if cache_dir is None:
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, 'search-%s'
+                        % (digest or _hash_series(taxonomy)))
+    if os.path.isdir(path):
+        _touch(path)
+        return LineageSearchIndex(
+            lineages, *(np.load(os.path.join(path, name + '.npy'),
+                                mmap_mode='r')
+                        for name in _SEARCH_ARRAYS))
+
+    index = LineageSearchIndex.from_lineages(lineages)
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-search-', dir=cache_dir)
+    for name in _SEARCH_ARRAYS:
+        np.save(os.path.join(tmp_path, name + '.npy'), getattr(index, name))
+    _commit_entry(cache_dir, tmp_path, path)
+    return index
+
+
+def _copy_table(table):
+    # Table.copy deep-copies every metadata dict, which costs more than the
+    # rest of a cache hit. The constructor copies the dicts already, and the
+    # observation metadata of a collapsed table holds only lists of feature
+    # IDs, so copying those lists is enough.
+    observation_metadata = table.metadata(axis='observation')
+    if observation_metadata is not None:
+        observation_metadata = [{key: copy.copy(value)
+                                 for key, value in md.items()}
+                                for md in observation_metadata]
+    return biom.Table(table.matrix_data.copy(),
+                      table.ids(axis='observation').copy(),
+                      table.ids(axis='sample').copy(),
+                      observation_metadata,
+                      copy.deepcopy(table.metadata(axis='sample')),
+                      table.table_id, type=table.type)
+
+
+class CollapseCache:
+    """Memoizes collapsed tables by the contents of their inputs.
+
+    Collapsed tables are keyed by content hashes of the feature table, of the
+    (table-aligned) TaxonomyIndex, and of the level. An in-process LRU tier
+    holds the ``MEMORY_CACHE_ENTRIES`` most recently used tables, backed by
+    an on-disk tier in the cache directory. Like the taxonomy cache, this is
+    disabled unless ``Q2_TAXA_CACHE_DIR`` is set.
+
+    Tables are copied as they are stored and returned, so callers may modify
+    their results in place without affecting the cache. Tables that are
+    cheaper to recompute than to load (e.g. levels rolled up from a cached
+    deeper level) can be kept in memory only.
+
+    ``memory_hits``, ``disk_hits`` and ``misses`` count lookups.
+    """
+
+    def __init__(self, max_entries=MEMORY_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._tables = collections.OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def clear(self):
+        self._tables.clear()
+        self.memory_hits = self.disk_hits = self.misses = 0
+
+    def key(self, table, taxonomy, level):
+        """Return the cache key, or None when caching is disabled."""
+        return self.level_key(self.inputs_key(table, taxonomy), level)
+
+    def inputs_key(self, table, taxonomy):
+        """Return the digest of the inputs, or None when caching is disabled.
+
+        Keys of the levels of the same inputs are derived from it with
+        ``level_key``, so the table and taxonomy are only hashed once.
+        """
+        if _cache_dir() is None:
+            return None
+        digest = hashlib.sha256()
+        digest.update(_hash_table(table).encode('ascii'))
+        digest.update(_hash_taxonomy_index(taxonomy).encode('ascii'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def level_key(inputs_key, level):
+        if inputs_key is None:
+            return None
+        digest = hashlib.sha256(inputs_key.encode('ascii'))
+        digest.update(str(level).encode('ascii'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(_cache_dir(), 'collapsed-%s' % key)
+
+    def get(self, key):
+        if key is None:
+            return None
+
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            self.memory_hits += 1
+            return _copy_table(self._tables[key])
+
+        path = self._path(key)
+        if os.path.isdir(path):
+            _touch(path)
+            table = biom.load_table(os.path.join(path, 'table.biom'))
+            self._remember(key, table)
+            self.disk_hits += 1
+            return _copy_table(table)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, table, persist=True):
+        if key is None:
+            return
+
+        self._remember(key, _copy_table(table))
+        if not persist:
+            return
+
+        cache_dir = _cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-collapsed-', dir=cache_dir)
+        with h5py.File(os.path.join(tmp_path, 'table.biom'), 'w') as fh:
+            table.to_hdf5(fh, 'q2-taxa')
+        _commit_entry(cache_dir, tmp_path, path)
+
+    def _remember(self, key, table):
+        self._tables[key] = table
+        self._tables.move_to_end(key)
+        while len(self._tables) > self.max_entries:
+            self._tables.popitem(last=False)
+
+
+collapse_cache = CollapseCache()
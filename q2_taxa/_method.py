@@ -6,116 +6,340 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import copy
+
+import numpy as np
 import pandas as pd
 import biom
 import qiime2
+from q2_types.feature_data import DNAFASTAFormat
+from q2_types.feature_table import BIOMV210Format
 
-from ._util import _collapse_table, _get_max_level
-
+from ._util import (_append_collapsed, _apply_collapse_plan,
+                    _collapse_hdf5_table, _collapse_levels, _collapse_plan,
+                    _collapse_presence_absence_table, _collapse_table,
+                    _collapse_tables, _fasta_ids, _filter_fasta,
+                    _get_max_level, _hdf5_ids, _index_taxonomy,
+                    _merge_collapse_hdf5_tables)
+from ._cache import (MIN_CACHED_FRACTION, _cached_search_index,
+                     _cached_taxonomy_index, _taxonomy_digest)
+from ._query import MODES, _evaluate_query, _parse_query
+from ._search import _match_lineages, _match_ranks
+from ._taxonomy import TaxonomyIndex
 
-def collapse(table: biom.Table, taxonomy: pd.Series,
-             level: int) -> biom.Table:
-    if level < 1:
-        raise ValueError('Requested level of %d is too low. Must be greater '
-                         'than or equal to 1.' % level)
-
-    # Assemble the taxonomy data
-    max_observed_level = _get_max_level(taxonomy)
 
+def _check_max_level(level, max_observed_level):
     if level > max_observed_level:
         raise ValueError('Requested level of %d is larger than the maximum '
                          'level available in taxonomy data (%d).' %
                          (level, max_observed_level))
 
-    return _collapse_table(table, taxonomy, level, max_observed_level)
+
+def _validate_levels(levels, taxonomy, max_level_source):
+    for level in levels:
+        if level < 1:
+            raise ValueError('Requested level of %d is too low. Must be '
+                             'greater than or equal to 1.' % level)
+
+    if max_level_source == 'taxonomy':
+        max_observed_level = _get_max_level(taxonomy)
+        for level in levels:
+            _check_max_level(level, max_observed_level)
+        return max_observed_level
+    elif max_level_source == 'table':
+        # can only be checked once the table's features are known
+        return None
+    else:
+        raise ValueError('Unknown max_level_source: %s' % max_level_source)
+
+
+def _index_collapse_taxonomy(feature_ids, taxonomy, levels,
+                             max_observed_level):
+    # Assemble the taxonomy data. Only the lineages of features present in
+    # the table are parsed.
+    taxonomy = _index_taxonomy(feature_ids, taxonomy, max_observed_level)
+    for level in levels:
+        _check_max_level(level, taxonomy.max_level)
+    return taxonomy
+
+
+def collapse(table: biom.Table, taxonomy: pd.Series, level: int,
+             max_level_source: str = 'taxonomy', n_jobs: int = 1,
+             min_frequency: int = 0, min_samples: int = 0,
+             relative: bool = False) -> biom.Table:
+    if n_jobs < 1:
+        raise ValueError('Requested number of jobs (%d) is too low. Must be '
+                         'greater than or equal to 1.' % n_jobs)
+    if min_frequency < 0 or min_samples < 0:
+        raise ValueError('The minimum frequency and minimum number of '
+                         'samples must be greater than or equal to 0.')
+
+    max_observed_level = _validate_levels([level], taxonomy,
+                                          max_level_source)
+    taxonomy = _index_collapse_taxonomy(table.ids(axis='observation'),
+                                        taxonomy, [level], max_observed_level)
+
+    return _collapse_table(table, taxonomy, level, n_jobs, min_frequency,
+                           min_samples, relative)
+
+
+def collapse_plan(table: biom.Table, taxonomy: pd.Series, level: int,
+                  max_level_source: str = 'taxonomy') -> pd.Series:
+    max_observed_level = _validate_levels([level], taxonomy,
+                                          max_level_source)
+    taxonomy = _index_collapse_taxonomy(table.ids(axis='observation'),
+                                        taxonomy, [level], max_observed_level)
+
+    return _collapse_plan(taxonomy, level)
+
+
+def collapse_with_plan(table: biom.Table, plan: pd.Series) -> biom.Table:
+    return _apply_collapse_plan(table, plan)
+
+
+def collapse_levels(table: biom.Table, taxonomy: pd.Series, levels: list,
+                    max_level_source: str = 'taxonomy',
+                    n_jobs: int = 1) -> biom.Table:
+    if len(levels) == 0:
+        raise ValueError('At least one level must be provided.')
+    if n_jobs < 1:
+        raise ValueError('Requested number of jobs (%d) is too low. Must be '
+                         'greater than or equal to 1.' % n_jobs)
+
+    max_observed_level = _validate_levels(levels, taxonomy, max_level_source)
+    taxonomy = _index_collapse_taxonomy(table.ids(axis='observation'),
+                                        taxonomy, levels, max_observed_level)
+
+    collapsed = _collapse_levels(table, taxonomy, levels, n_jobs)
+    return {'level-%d' % level: collapsed[level] for level in levels}
+
+
+def collapse_batch(tables: biom.Table, taxonomy: pd.Series, levels: list,
+                   max_level_source: str = 'taxonomy',
+                   n_jobs: int = 1) -> biom.Table:
+    if len(levels) == 0:
+        raise ValueError('At least one level must be provided.')
+    if n_jobs < 1:
+        raise ValueError('Requested number of jobs (%d) is too low. Must be '
+                         'greater than or equal to 1.' % n_jobs)
+
+    max_observed_level = _validate_levels(levels, taxonomy, max_level_source)
+    feature_ids = pd.unique(np.concatenate(
+        [table.ids(axis='observation') for table in tables.values()]))
+    taxonomy = _index_collapse_taxonomy(feature_ids, taxonomy, levels,
+                                        max_observed_level)
+
+    collapsed = _collapse_tables(tables, taxonomy, levels, n_jobs)
+    return {'%s-level-%d' % (name, level): collapsed_table
+            for name, collapsed_tables in collapsed.items()
+            for level, collapsed_table in zip(levels, collapsed_tables)}
+
+
+def collapse_streaming(table: BIOMV210Format, taxonomy: pd.Series,
+                       level: int, max_level_source: str = 'taxonomy',
+                       block_size: int = 1000) -> biom.Table:
+    if block_size < 1:
+        raise ValueError('Requested block size of %d is too low. Must be '
+                         'greater than or equal to 1.' % block_size)
+
+    max_observed_level = _validate_levels([level], taxonomy,
+                                          max_level_source)
+    fp = str(table)
+    taxonomy = _index_collapse_taxonomy(_hdf5_ids(fp, 'observation'),
+                                        taxonomy, [level], max_observed_level)
+
+    return _collapse_hdf5_table(fp, taxonomy, level, block_size)
+
+
+def collapse_merge(tables: BIOMV210Format, taxonomy: pd.Series,
+                   level: int, max_level_source: str = 'taxonomy',
+                   overlap_method: str = 'error_on_overlapping_sample',
+                   block_size: int = 1000) -> biom.Table:
+    if len(tables) == 0:
+        raise ValueError('At least one table must be provided.')
+    if block_size < 1:
+        raise ValueError('Requested block size of %d is too low. Must be '
+                         'greater than or equal to 1.' % block_size)
+    if overlap_method not in ('error_on_overlapping_sample', 'sum'):
+        raise ValueError('Unknown overlap_method: %r' % overlap_method)
+
+    max_observed_level = _validate_levels([level], taxonomy,
+                                          max_level_source)
+    fps = [str(table) for table in tables]
+    feature_ids = pd.unique(np.concatenate(
+        [_hdf5_ids(fp, 'observation') for fp in fps]))
+    taxonomy = _index_collapse_taxonomy(feature_ids, taxonomy, [level],
+                                        max_observed_level)
+
+    return _merge_collapse_hdf5_tables(fps, taxonomy, level, block_size,
+                                       overlap_method)
+
+
+def collapse_incremental(collapsed_table: biom.Table, table: biom.Table,
+                         taxonomy: pd.Series, level: int,
+                         max_level_source: str = 'taxonomy') -> biom.Table:
+    max_observed_level = _validate_levels([level], taxonomy,
+                                          max_level_source)
+
+    mismatched = [e for e in collapsed_table.ids(axis='observation')
+                  if e.count(';') + 1 != level]
+    if mismatched:
+        raise ValueError('The collapsed table does not appear to be collapsed '
+                         'at level %d. The following feature IDs do not have '
+                         '%d levels: %s' % (level, level,
+                                            ', '.join(mismatched)))
+
+    taxonomy = _index_collapse_taxonomy(table.ids(axis='observation'),
+                                        taxonomy, [level], max_observed_level)
+
+    return _append_collapsed(collapsed_table, table, taxonomy, level)
+
+
+def collapse_presence_absence(table: biom.Table, taxonomy: pd.Series,
+                              level: int, max_level_source: str = 'taxonomy'
+                              ) -> biom.Table:
+    max_observed_level = _validate_levels([level], taxonomy,
+                                          max_level_source)
+    taxonomy = _index_collapse_taxonomy(table.ids(axis='observation'),
+                                        taxonomy, [level], max_observed_level)
+
+    return _collapse_presence_absence_table(table, taxonomy, level)
 
 
 def _ids_to_keep_from_taxonomy(feature_ids, taxonomy, include, exclude,
-                               query_delimiter, mode):
-    if include is None and exclude is None:
+                               query_delimiter, mode, query=None):
+    if include is None and exclude is None and query is None:
         raise ValueError("At least one filtering term must be provided.")
 
-    ids_without_taxonomy = set(feature_ids) - set(taxonomy.ids)
-    if len(ids_without_taxonomy) > 0:
+    if mode not in MODES:
+        raise ValueError('Unknown mode: %s' % mode)
+    modes = {mode} if include is not None or exclude is not None else set()
+    if query is not None:
+        query = _parse_query(query, mode)
+        modes.update(e[1][0] for e in query if e[0] == 'term')
+
+    series = taxonomy.get_column('Taxon').to_series()
+    feature_ids = np.asarray(feature_ids, dtype=object)
+    # As when collapsing, the caches are only used when the features are not
+    # a small part of the taxonomy, and the taxonomy is hashed once for both.
+    index = None
+    if len(feature_ids) >= MIN_CACHED_FRACTION * len(series):
+        digest = _taxonomy_digest(series)
+        if digest is not None:
+            index = _cached_taxonomy_index(series, digest)
+    if index is not None:
+        positions = index.get_indexer(feature_ids)
+    else:
+        positions = series.index.get_indexer(feature_ids)
+    if (positions == -1).any():
         raise ValueError("All features ids must be present in taxonomy, but "
                          "the following feature ids are not: %s"
-                         % ', '.join(ids_without_taxonomy))
-
-    # Remove feature ids from taxonomy that are not present in
-    # feature_ids (this simplifies the actual filtering step downstream) by
-    # ensuring that there are no "extra ids" in the returned ids_to_keep.
-    taxonomy = taxonomy.filter_ids(feature_ids)
-
-    if mode == 'exact':
-        query_template = "Taxon='%s'"
-    elif mode == 'contains':
-        if include is not None:
-            include = include.replace('_', '\\_')
-        if exclude is not None:
-            exclude = exclude.replace('_', '\\_')
-        query_template = "Taxon LIKE '%%%s%%' ESCAPE '\\'"
+                         % ', '.join(feature_ids[positions == -1]))
+
+    # Terms are matched once per distinct lineage rather than once per
+    # feature, and then mapped back to the features carrying that lineage.
+    # When the caches are used, exact and contains terms are answered from
+    # the persistent search index over all lineages of the taxonomy.
+    # Otherwise, only the lineages of the features in feature_ids are parsed
+    # and matched.
+    search_index = None
+    if index is not None and modes & {'exact', 'contains'}:
+        search_index = _cached_search_index(series, index.lineages, digest)
+    if search_index is not None:
+        taxonomy = index
+        lineage_codes = index.lineage_codes[positions]
     else:
-        raise ValueError('Unknown mode: %s' % mode)
+        if index is not None:
+            taxonomy = index.take(positions)
+        else:
+            taxonomy = TaxonomyIndex.from_series(series.iloc[positions])
+        lineage_codes = taxonomy.lineage_codes
 
-    # First identify the features that are included (if no includes are
-    # provided, include all features).
+    def match(terms, mode):
+        if mode == 'rank':
+            return _match_ranks(taxonomy, terms)
+        if mode == 'contains':
+            # underscores are literal characters in taxonomy queries,
+            # rather than single-character wildcards.
+            terms = [e.replace('_', '\\_') for e in terms]
+        if search_index is not None:
+            return search_index.match(terms, mode)
+        return _match_lineages(taxonomy.lineages, terms, mode)
+
+    # First identify the lineages that are included (if no includes are
+    # provided, include all lineages).
     if include is not None:
-        include = include.split(query_delimiter)
-        ids_to_keep = set()
-        for e in include:
-            query = query_template % e
-            # an sqlite database is being built for every query. if performance
-            # becomes an issue, this is a target for refactoring.
-            ids_to_keep |= set(taxonomy.get_ids(where=query))
+        keep = match(include.split(query_delimiter), mode)
     else:
-        ids_to_keep = set(feature_ids)
+        keep = np.ones(len(taxonomy.lineages), dtype=bool)
 
-    # Then, remove features that are excluded.
+    # Then, remove lineages that are excluded.
     if exclude is not None:
-        exclude = exclude.split(query_delimiter)
-        for e in exclude:
-            query = query_template % e
-            # an sqlite database is being built for every query. if performance
-            # becomes an issue, this is a target for refactoring.
-            ids_to_keep -= set(taxonomy.get_ids(where=query))
+        keep &= ~match(exclude.split(query_delimiter), mode)
+
+    # Finally, keep only the lineages selected by the query.
+    if query is not None:
+        keep &= _evaluate_query(query, match)
 
-    return list(ids_to_keep)
+    return list(feature_ids[keep[lineage_codes]])
 
 
-def filter_table(table: pd.DataFrame, taxonomy: qiime2.Metadata,
+def filter_table(table: biom.Table, taxonomy: qiime2.Metadata,
                  include: str = None, exclude: str = None,
-                 query_delimiter: str = ',', mode: str = 'contains') \
-                 -> pd.DataFrame:
+                 query_delimiter: str = ',', mode: str = 'contains',
+                 query: str = None) -> biom.Table:
     ids_to_keep = _ids_to_keep_from_taxonomy(
-        table.columns, taxonomy, include, exclude, query_delimiter,
-        mode)
+        table.ids(axis='observation'), taxonomy, include, exclude,
+        query_delimiter, mode, query)
 
     if len(ids_to_keep) == 0:
         raise ValueError("All features were filtered, resulting in an "
                          "empty table.")
 
-    # filter the table to only the ids that should be retained
-    table = table[list(ids_to_keep)]
+    # filter the table to only the ids that should be retained. Only the kept
+    # rows of the sparse matrix are copied, and the input is left unchanged.
+    feature_ids = table.ids(axis='observation')
+    rows = pd.Index(feature_ids).get_indexer(ids_to_keep)
+    data = table.matrix_data[rows]
 
     # drop samples that now have a zero-count
-    table = table[table.T.sum() > 0]
-    if table.shape[0] == 0:
+    nonzero = np.asarray(data.sum(axis=0)).ravel() > 0
+    if not nonzero.any():
         raise ValueError("All features with frequencies greater than zero "
                          "were filtered, resulting in an empty table.")
+    columns = np.flatnonzero(nonzero)
+    if not nonzero.all():
+        data = data[:, columns]
+
+    observation_metadata = table.metadata(axis='observation')
+    if observation_metadata is not None:
+        observation_metadata = [copy.deepcopy(observation_metadata[i])
+                                for i in rows]
+    sample_metadata = table.metadata(axis='sample')
+    if sample_metadata is not None:
+        sample_metadata = [copy.deepcopy(sample_metadata[i])
+                           for i in columns]
 
-    return table
+    return biom.Table(
+        data, feature_ids[rows], table.ids(axis='sample')[columns],
+        observation_metadata, sample_metadata, table.table_id,
+        type=table.type)
 
 
-def filter_seqs(sequences: pd.Series, taxonomy: qiime2.Metadata,
+def filter_seqs(sequences: DNAFASTAFormat, taxonomy: qiime2.Metadata,
                 include: str = None, exclude: str = None,
-                query_delimiter: str = ',', mode: str = 'contains') \
-                -> pd.Series:
+                query_delimiter: str = ',', mode: str = 'contains',
+                query: str = None) -> DNAFASTAFormat:
+    # Only the sequence IDs are read up front; the records themselves are
+    # streamed from the input file to the output file.
     ids_to_keep = _ids_to_keep_from_taxonomy(
-        sequences.index, taxonomy, include, exclude, query_delimiter,
-        mode)
+        _fasta_ids(str(sequences)), taxonomy, include, exclude,
+        query_delimiter, mode, query)
 
     if len(ids_to_keep) == 0:
         raise ValueError("All features were filtered, resulting in an "
                          "empty collection of feature sequences.")
 
-    return sequences[ids_to_keep]
+    result = DNAFASTAFormat()
+    _filter_fasta(str(sequences), str(result), ids_to_keep)
+    return result
@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+MODES = ('exact', 'contains', 'rank', 'regex')
+_OPERATORS = ('AND', 'OR', 'NOT')
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<paren>[()])
+      | (?:(?P<mode>%s):)?
+        (?:"(?P<quoted>(?:[^"\\]|\\.)*)"|(?P<word>[^\s()"]+))
+    )''' % '|'.join(MODES), re.VERBOSE)
+
+
+def _tokenize(query, default_mode):
+    # Yields ('(', None), (')', None), (operator, None) or
+    # ('term', (mode, value)) tokens.
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN.match(query, position)
+        if match is None:
+            raise ValueError('Invalid query: unexpected %r at position %d.'
+                             % (query[position:].strip()[:20], position))
+        position = match.end()
+        if match.group('paren'):
+            yield match.group('paren'), None
+        elif match.group('quoted') is not None:
+            value = re.sub(r'\\(.)', r'\1', match.group('quoted'))
+            yield 'term', (match.group('mode') or default_mode, value)
+        elif match.group('mode') is None and \
+                match.group('word') in _OPERATORS:
+            yield match.group('word'), None
+        else:
+            yield 'term', (match.group('mode') or default_mode,
+                           match.group('word'))
+
+
+class _Parser:
+    """Recursive-descent parser from a query to a postfix plan.
+
+    The grammar, in order of increasing precedence, is::
+
+        expression := conjunction ('OR' conjunction)*
+        conjunction := negation ('AND' negation)*
+        negation := 'NOT' negation | '(' expression ')' | term
+    """
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.position = 0
+        self.plan = []
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def _next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError('Invalid query: the query is empty.')
+        self._expression()
+        if self._peek() is not None:
+            raise ValueError('Invalid query: unexpected %r.' % self._peek())
+        return self.plan
+
+    def _expression(self):
+        self._conjunction()
+        while self._peek() == 'OR':
+            self._next()
+            self._conjunction()
+            self.plan.append(('OR',))
+
+    def _conjunction(self):
+        self._negation()
+        while self._peek() == 'AND':
+            self._next()
+            self._negation()
+            self.plan.append(('AND',))
+
+    def _negation(self):
+        kind = self._peek()
+        if kind == 'NOT':
+            self._next()
+            self._negation()
+            self.plan.append(('NOT',))
+        elif kind == '(':
+            self._next()
+            self._expression()
+            if self._peek() != ')':
+                raise ValueError('Invalid query: missing closing '
+                                 'parenthesis.')
+            self._next()
+        elif kind == 'term':
+            self.plan.append(self._next())
+        elif kind is None:
+            raise ValueError('Invalid query: unexpected end of query.')
+        else:
+            raise ValueError('Invalid query: unexpected %r.' % kind)
+
+
+def _parse_query(query, default_mode):
+    """Compile a boolean ``query`` into a postfix plan.
+
+    Terms are words or double-quoted strings (in which ``\\`` escapes the
+    next character), optionally prefixed by the mode they are matched with
+    (e.g. ``rank:g__:Bacteroides`` or ``regex:"^k__"``); terms without a
+    prefix use ``default_mode``. Terms are combined with ``AND``, ``OR``,
+    ``NOT`` and parentheses. The plan holds ``('term', (mode, value))`` and
+    operator entries.
+    """
+    return _Parser(_tokenize(query, default_mode)).parse()
+
+
+def _evaluate_query(plan, match):
+    """Evaluate a postfix ``plan`` into a lineage mask.
+
+    ``match(terms, mode)`` returns the lineage mask of a list of terms. Every
+    distinct term is matched once, and the plan is then evaluated with
+    vectorized boolean operations over the term masks.
+    """
+    masks = {}
+    for entry in plan:
+        if entry[0] == 'term' and entry[1] not in masks:
+            mode, value = entry[1]
+            masks[entry[1]] = match([value], mode)
+
+    stack = []
+    for entry in plan:
+        if entry[0] == 'term':
+            stack.append(masks[entry[1]])
+        elif entry[0] == 'NOT':
+            stack.append(~stack.pop())
+        else:
+            right, left = stack.pop(), stack.pop()
+            stack.append(left & right if entry[0] == 'AND' else left | right)
+    return stack.pop()
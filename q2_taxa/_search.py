@@ -0,0 +1,254 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import re
+
+import numpy as np
+import pandas as pd
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+                             'abcdefghijklmnopqrstuvwxyz')
+# Code points fit into 21 bits, so a trigram packs into one uint64.
+_CODE_POINT_BITS = 21
+
+
+def _like_tokens(pattern, escape):
+    # Yields (True, char) for literal characters, (None, char) for the % and
+    # _ wildcards, and a final (False, None) for an unpaired trailing escape.
+    chars = iter(pattern)
+    for char in chars:
+        if char == escape:
+            char = next(chars, None)
+            if char is None:
+                yield False, None
+                return
+            yield True, char
+        elif char in '%_':
+            yield None, char
+        else:
+            yield True, char
+
+
+def _like_to_regex(pattern, escape='\\'):
+    """Translate a SQL ``LIKE`` pattern into an equivalent regex.
+
+    ``%`` matches any run of characters, ``_`` matches one character, and
+    ``escape`` makes the character after it literal. As in SQLite, a pattern
+    ending in an unpaired ``escape`` matches nothing, in which case None is
+    returned. The regex is anchored only where the pattern is not bounded by
+    ``%``, so it can be used with ``re.search``.
+    """
+    tokens = []
+    for literal, char in _like_tokens(pattern, escape):
+        if literal is False:
+            return None
+        elif literal:
+            tokens.append(re.escape(char))
+        elif char == '%':
+            tokens.append('.*')
+        else:
+            tokens.append('.')
+
+    head = r'\A'
+    while tokens and tokens[0] == '.*':
+        tokens.pop(0)
+        head = ''
+    tail = r'\Z'
+    while tokens and tokens[-1] == '.*':
+        tokens.pop()
+        tail = ''
+    return head + ''.join(tokens) + tail
+
+
+def _like_literals(pattern, escape='\\'):
+    """The runs of literal characters that any match of ``pattern`` holds."""
+    literals = ['']
+    for literal, char in _like_tokens(pattern, escape):
+        if literal:
+            literals[-1] += char
+        elif literals[-1]:
+            literals.append('')
+    return [e for e in literals if e]
+
+
+def _match_lineages(lineages, terms, mode):
+    """Mask of the ``lineages`` that match any of ``terms``.
+
+    In ``exact`` mode a lineage matches a term it is equal to. In
+    ``contains`` mode the terms are matched as SQL ``LIKE '%term%'`` patterns
+    with ``\\`` as the escape character, and, as in SQL, case-insensitively
+    for ASCII letters only. The ``contains`` terms are compiled into one
+    pattern, so every lineage is scanned once. In ``regex`` mode the terms
+    are regular expressions, and a lineage matches if any of them matches
+    anywhere in it. Each regular expression is matched on its own, as inline
+    flags, group numbers and group names are only meaningful within the term
+    that they appear in.
+    """
+    if mode == 'exact':
+        return pd.Index(lineages).isin(terms)
+
+    if mode == 'regex':
+        searches = []
+        for term in terms:
+            try:
+                searches.append(re.compile(term).search)
+            except re.error as e:
+                raise ValueError('Invalid regular expression %r: %s'
+                                 % (term, e))
+    else:
+        patterns = [_like_to_regex('%' + term + '%') for term in terms]
+        patterns = [e for e in patterns if e is not None]
+        searches = []
+        if patterns:
+            searches.append(re.compile(
+                '|'.join('(?:%s)' % e for e in patterns),
+                re.ASCII | re.IGNORECASE | re.DOTALL).search)
+
+    mask = np.zeros(len(lineages), dtype=bool)
+    for search in searches:
+        mask |= np.fromiter((search(e) is not None for e in lineages),
+                            dtype=bool, count=len(lineages))
+    return mask
+
+
+def _match_ranks(taxonomy, terms):
+    """Mask of the lineages of ``taxonomy`` that match any rank-scoped term.
+
+    Terms have the form ``<rank>:<name>``. When ``<rank>`` is a number, a
+    lineage matches if its rank at that level (counting from 1) is ``name``.
+    Otherwise ``<rank>`` is a rank prefix such as ``g__``, and a lineage
+    matches if it has a rank equal to ``<rank><name>`` at any level. Terms
+    are looked up in each rank's vocabulary, so every level costs one pass
+    over its integer codes no matter how many terms there are.
+    """
+    any_level = set()
+    by_level = {}
+    for term in terms:
+        rank, sep, name = term.partition(':')
+        if not sep:
+            raise ValueError('Rank-scoped search terms must have the form '
+                             '<rank>:<name> (e.g. g__:Bacteroides), but '
+                             'found: %r' % term)
+        rank, name = rank.strip(), name.strip()
+        if rank.isdigit():
+            level = int(rank)
+            if level < 1:
+                raise ValueError('Requested level of %d is too low. Must be '
+                                 'greater than or equal to 1.' % level)
+            by_level.setdefault(level - 1, set()).add(name)
+        else:
+            any_level.add(rank + name)
+
+    mask = np.zeros(len(taxonomy.lineages), dtype=bool)
+    for level in range(taxonomy.max_level):
+        names = any_level | by_level.get(level, set())
+        if names:
+            matches = pd.Index(taxonomy.vocabularies[level]).isin(names)
+            mask |= matches[taxonomy.ranks[level]]
+    return mask
+
+
+def _code_points(strings):
+    strings = ''.join(strings)
+    return np.frombuffer(strings.encode('utf-32-le'), dtype='<u4')
+
+
+def _pack_trigrams(code_points):
+    code_points = code_points.astype(np.uint64)
+    return ((code_points[:-2] << np.uint64(2 * _CODE_POINT_BITS)) |
+            (code_points[1:-1] << np.uint64(_CODE_POINT_BITS)) |
+            code_points[2:])
+
+
+class LineageSearchIndex:
+    """Trigram index over distinct lineage strings.
+
+    For every trigram of the (ASCII lower-cased) lineages, the index holds a
+    sorted posting list of the lineages containing it: ``postings[
+    offsets[i]:offsets[i + 1]]`` for ``trigrams[i]``. A ``contains`` term can
+    only match lineages that hold every trigram of its literal runs, so terms
+    are answered by intersecting posting lists and then matching just those
+    candidate lineages, with the same semantics as ``_match_lineages``.
+    """
+
+    def __init__(self, lineages, trigrams, offsets, postings):
+        self.lineages = np.asarray(lineages, dtype=object)
+        self.trigrams = trigrams
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def from_lineages(cls, lineages):
+        lineages = np.asarray(lineages, dtype=object)
+        lowered = [e.translate(_ASCII_LOWER) for e in lineages]
+        lengths = np.fromiter((len(e) for e in lowered), dtype=np.intp,
+                              count=len(lowered))
+        owners = np.repeat(np.arange(len(lowered), dtype=np.int32), lengths)
+
+        trigrams = _pack_trigrams(_code_points(lowered))
+        # trigrams spanning two concatenated lineages are not indexed
+        trigram_owners = owners[:len(trigrams)]
+        within = trigram_owners == owners[2:]
+        trigrams, trigram_owners = trigrams[within], trigram_owners[within]
+
+        order = np.lexsort((trigram_owners, trigrams))
+        trigrams, trigram_owners = trigrams[order], trigram_owners[order]
+        distinct = np.ones(len(trigrams), dtype=bool)
+        distinct[1:] = ((trigrams[1:] != trigrams[:-1]) |
+                        (trigram_owners[1:] != trigram_owners[:-1]))
+        trigrams, postings = trigrams[distinct], trigram_owners[distinct]
+
+        trigrams, starts = np.unique(trigrams, return_index=True)
+        offsets = np.append(starts, len(postings)).astype(np.intp)
+        return cls(lineages, trigrams, offsets, postings)
+
+    def _posting(self, trigram):
+        i = np.searchsorted(self.trigrams, trigram)
+        if i == len(self.trigrams) or self.trigrams[i] != trigram:
+            return np.array([], dtype=np.int32)
+        return self.postings[self.offsets[i]:self.offsets[i + 1]]
+
+    def candidates(self, pattern):
+        """Lineages that may match the ``LIKE`` ``pattern``.
+
+        Returns None when the pattern has no literal run of three or more
+        characters, in which case every lineage is a candidate.
+        """
+        trigrams = np.unique(np.concatenate(
+            [_pack_trigrams(_code_points(e.translate(_ASCII_LOWER)))
+             for e in _like_literals(pattern) if len(e) >= 3] +
+            [np.array([], dtype=np.uint64)]))
+        if len(trigrams) == 0:
+            return None
+
+        # Intersect from the shortest posting list, looking the remaining
+        # candidates up in each longer (sorted) list by binary search.
+        postings = sorted((self._posting(e) for e in trigrams), key=len)
+        candidates = np.asarray(postings[0], dtype=np.intp)
+        for posting in postings[1:]:
+            if len(candidates) == 0:
+                break
+            found = np.searchsorted(posting, candidates)
+            found[found == len(posting)] = 0
+            candidates = candidates[posting[found] == candidates]
+        return candidates
+
+    def match(self, terms, mode):
+        """Mask of the lineages that match any of ``terms``."""
+        if mode != 'contains':
+            return _match_lineages(self.lineages, terms, mode)
+
+        mask = np.zeros(len(self.lineages), dtype=bool)
+        for term in terms:
+            candidates = self.candidates('%' + term + '%')
+            if candidates is None:
+                mask |= _match_lineages(self.lineages, [term], mode)
+            else:
+                mask[candidates] |= _match_lineages(
+                    self.lineages[candidates], [term], mode)
+        return mask
@@ -0,0 +1,177 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+
+class TaxonomyIndex:
+    """Array-backed, integer-coded view of a feature taxonomy.
+
+    Each distinct lineage string is stored once in ``lineages`` and features
+    refer to it through ``lineage_codes``. Distinct lineages are kept in order
+    of their first appearance among the features, so any grouping computed
+    over lineages has the same order as the equivalent grouping computed over
+    features.
+
+    Ranks are parsed lazily, and only once per distinct lineage: each lineage
+    is split on ``;``, stripped, and padded with ``__`` up to ``max_level``.
+    The result is one categorical code array per rank (``ranks``, with shape
+    ``(max_level, len(lineages))``) and one vocabulary per rank.
+
+    ``max_level`` defaults to the deepest lineage in the index. It can be set
+    explicitly when the index only covers a subset of a larger taxonomy whose
+    depth should still determine the padding.
+    """
+
+    def __init__(self, ids, lineage_codes, lineages, ranks=None,
+                 vocabularies=None, depths=None, max_level=None,
+                 sorted_ids=None, id_order=None):
+        self._ids = ids
+        self.lineage_codes = np.asarray(lineage_codes, dtype=np.intp)
+        self._lineages = lineages
+        self._ranks = ranks
+        self._vocabularies = vocabularies
+        self._depths = depths
+        self._max_level = max_level
+        # IDs sorted in string order, with their positions in ``ids``; when
+        # provided, a few IDs are looked up by binary search rather than
+        # through a hash table over every ID.
+        self._sorted_ids = sorted_ids
+        self._id_order = id_order
+
+    @classmethod
+    def from_series(cls, taxonomy, max_level=None):
+        lineage_codes, lineages = pd.factorize(
+            np.asarray(taxonomy.values, dtype=object))
+        return cls(taxonomy.index, lineage_codes, lineages,
+                   max_level=max_level)
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def ids(self):
+        # IDs and lineages may be memory-mapped arrays, which are only
+        # converted when they are needed as a whole.
+        if not isinstance(self._ids, pd.Index):
+            self._ids = pd.Index(np.asarray(self._ids, dtype=object))
+        return self._ids
+
+    @property
+    def lineages(self):
+        if self._lineages.dtype != object:
+            self._lineages = np.asarray(self._lineages, dtype=object)
+        return self._lineages
+
+    @property
+    def ranks(self):
+        if self._ranks is None:
+            self._parse()
+        return self._ranks
+
+    @property
+    def vocabularies(self):
+        if self._vocabularies is None:
+            self._parse()
+        return self._vocabularies
+
+    @property
+    def depths(self):
+        if self._depths is None:
+            self._parse()
+        return self._depths
+
+    @property
+    def max_level(self):
+        return self.ranks.shape[0]
+
+    def _parse(self):
+        split = pd.Series(self.lineages, dtype=object).str.split(
+            ';', expand=True)
+        depths = split.notna().sum(axis=1).to_numpy(dtype=np.intp)
+        max_level = split.shape[1] if len(split) > 0 else 0
+        if self._max_level is not None:
+            max_level = max(max_level, self._max_level)
+
+        ranks = np.empty((max_level, len(split)), dtype=np.int32)
+        vocabularies = []
+        for level in range(max_level):
+            if level < split.shape[1]:
+                column = split[level].str.strip().fillna('__')
+            else:
+                column = pd.Series('__', index=split.index, dtype=object)
+            ranks[level], vocabulary = pd.factorize(column.to_numpy())
+            vocabularies.append(np.asarray(vocabulary, dtype=object))
+
+        self._ranks = ranks
+        self._vocabularies = vocabularies
+        self._depths = depths
+
+    def rank_codes(self, level):
+        """Per-feature codes into ``vocabularies[level]``."""
+        return self.ranks[level][self.lineage_codes]
+
+    def get_indexer(self, ids):
+        """Row positions of ``ids``, with -1 marking IDs not in the index."""
+        # Sorting many IDs for the binary searches costs more than hashing
+        # every ID of the index.
+        if self._sorted_ids is None or len(ids) * 8 > len(self._sorted_ids):
+            return self.ids.get_indexer(ids)
+
+        ids = np.asarray(ids, dtype=str)
+        positions = np.full(len(ids), -1, dtype=np.intp)
+        if len(self._sorted_ids) == 0:
+            return positions
+        # Searching for the IDs in sorted order keeps the binary searches
+        # (and the pages of the memory-mapped IDs that they read) local.
+        order = np.argsort(ids, kind='stable')
+        found = np.searchsorted(self._sorted_ids, ids[order])
+        found[found == len(self._sorted_ids)] = 0
+        matched = self._sorted_ids[found] == ids[order]
+        positions[order[matched]] = self._id_order[found[matched]]
+        return positions
+
+    def take(self, positions):
+        """Return the index restricted to (and ordered by) ``positions``."""
+        lineage_codes, used = pd.factorize(self.lineage_codes[positions])
+        if self._ranks is None:
+            return TaxonomyIndex(self._ids[positions], lineage_codes,
+                                 self._lineages[used],
+                                 max_level=self._max_level)
+        return TaxonomyIndex(self._ids[positions], lineage_codes,
+                             self._lineages[used], self._ranks[:, used],
+                             self._vocabularies, self._depths[used],
+                             self._max_level)
+
+    def truncate(self, max_level):
+        """Return the index with ranks deeper than ``max_level`` removed."""
+        return TaxonomyIndex(self._ids, self.lineage_codes, self._lineages,
+                             self.ranks[:max_level],
+                             self.vocabularies[:max_level],
+                             np.minimum(self.depths, max_level),
+                             sorted_ids=self._sorted_ids,
+                             id_order=self._id_order)
+
+    def groups(self, level):
+        """Group features by their lineage truncated to ``level`` ranks.
+
+        Returns the per-feature group codes and the group labels, with groups
+        in order of their first appearance among the features.
+        """
+        codes = np.zeros(len(self._lineages), dtype=np.intp)
+        for rank in range(level):
+            key = codes * len(self.vocabularies[rank]) + self.ranks[rank]
+            codes, _ = pd.factorize(key)
+
+        _, first = np.unique(codes, return_index=True)
+        labels = [';'.join(e) for e in zip(
+            *(self.vocabularies[rank][self.ranks[rank][first]]
+              for rank in range(level)))]
+
+        return codes[self.lineage_codes], np.asarray(labels, dtype=object)
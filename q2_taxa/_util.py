@@ -6,45 +6,595 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import biom
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from ._cache import (MIN_CACHED_FRACTION, _cached_taxonomy_index,
+                     collapse_cache)
+from ._taxonomy import TaxonomyIndex
+
 
 def _get_max_level(taxonomy):
-    return taxonomy.apply(lambda x: len(x.split(';'))).max()
+    return int(taxonomy.str.count(';').max()) + 1
 
 
-def _collapse_table(table, taxonomy, level, max_observed_level):
-    table_ids = set(table.ids(axis='observation'))
-    taxonomy_ids = set(taxonomy.index)
-    missing_ids = table_ids.difference(taxonomy_ids)
-    if len(missing_ids) > 0:
+def _check_missing_ids(feature_ids, positions):
+    missing = positions == -1
+    if missing.any():
         raise ValueError('Feature IDs found in the table are missing from the '
-                         'taxonomy: {}'.format(missing_ids))
+                         'taxonomy: {}'.format(set(feature_ids[missing])))
 
-    table = table.copy()
 
-    def _collapse(id_, md):
-        tax = taxonomy.loc[id_]
-        tax = [x.strip() for x in tax.split(';')]
-        if len(tax) < max_observed_level:
-            padding = ['__'] * (max_observed_level - len(tax))
-            tax.extend(padding)
-        return ';'.join(tax[:level])
+def _index_taxonomy(feature_ids, taxonomy, max_level=None):
+    """Build a TaxonomyIndex over only the features in ``feature_ids``.
 
-    return table.collapse(_collapse, axis='observation', norm=False)
+    Lineages of taxonomy entries that are not in ``feature_ids`` are never
+    parsed, unless the compiled index of the full taxonomy is (or will be)
+    in the on-disk cache. The cache is only used when ``feature_ids`` cover
+    at least ``MIN_CACHED_FRACTION`` of the taxonomy. If ``max_level`` is not
+    provided, the maximum observed level (and therefore the padding) is
+    based on those features only.
+    """
+    index = None
+    if len(feature_ids) >= MIN_CACHED_FRACTION * len(taxonomy):
+        index = _cached_taxonomy_index(taxonomy)
+    if index is not None:
+        positions = index.get_indexer(feature_ids)
+        _check_missing_ids(feature_ids, positions)
+        index = index.take(positions)
+        if max_level is None:
+            index = index.truncate(index.depths.max(initial=0))
+        return index
 
+    positions = taxonomy.index.get_indexer(feature_ids)
+    _check_missing_ids(feature_ids, positions)
+    return TaxonomyIndex.from_series(taxonomy.iloc[positions],
+                                     max_level=max_level)
 
-def _extract_to_level(taxonomy, table):
-    # Assemble the taxonomy data
-    max_obs_lvl = _get_max_level(taxonomy)
 
-    collapsed_tables = []
-    # Collapse table at specified level
-    for level in range(1, max_obs_lvl + 1):
-        collapsed_table = _collapse_table(table, taxonomy, level, max_obs_lvl)
-        as_df = _biom_to_df(collapsed_table)
-        collapsed_tables.append(as_df)
+def _align_taxonomy(table, taxonomy):
+    feature_ids = table.ids(axis='observation')
+    if taxonomy.ids.equals(pd.Index(feature_ids)):
+        return taxonomy
+    positions = taxonomy.get_indexer(feature_ids)
+    _check_missing_ids(feature_ids, positions)
+    return taxonomy.take(positions)
+
+
+def _accumulator_dtype(dtype):
+    # Integer counts are summed as int64 so that collapsing cannot overflow a
+    # narrower input dtype. Floating point counts are summed as they are.
+    if np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int64)
+    return np.dtype(dtype)
+
+
+def _compact_dtype(values):
+    """Smallest of uint32, int32 and int64 that holds ``values`` exactly.
+
+    Returns the dtype of ``values`` unchanged when they are not integral or
+    do not fit into int64.
+    """
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.dtype(np.uint32)
+    if not np.issubdtype(values.dtype, np.integer):
+        if not np.all(np.isfinite(values)) or \
+                not np.array_equal(values, np.trunc(values)):
+            return values.dtype
+    low, high = values.min(), values.max()
+    for dtype in (np.uint32, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return values.dtype
+
+
+def _sums_exactly(values):
+    """Whether every sum over ``values`` is exact in any order.
+
+    This holds for integral values whose absolute total is below 2 ** 53,
+    the largest range in which float64 represents every integer.
+    """
+    values = np.asarray(values)
+    return (np.issubdtype(_compact_dtype(values), np.integer) and
+            np.abs(values).sum() < 2 ** 53)
+
+
+def _indicator_matrix(group_codes, n_groups, dtype):
+    # Features with a negative group code are left out of every group.
+    n_features = len(group_codes)
+    features = np.flatnonzero(group_codes >= 0)
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(features), dtype=dtype),
+         (group_codes[features], features)),
+        shape=(n_groups, n_features))
+
+
+def _collapsed_metadata(feature_ids, group_codes, n_groups):
+    if n_groups == 0:
+        return []
+    grouped = group_codes >= 0
+    feature_ids = np.asarray(feature_ids)[grouped]
+    group_codes = group_codes[grouped]
+    order = np.argsort(group_codes, kind='stable')
+    bounds = np.cumsum(np.bincount(group_codes, minlength=n_groups))[:-1]
+    return [{'collapsed_ids': ids.tolist()}
+            for ids in np.split(feature_ids[order], bounds)]
+
+
+def _group_blocks(indicator, n_blocks):
+    # Split the groups into runs holding about the same number of features,
+    # so that every block is about the same amount of work.
+    n_blocks = min(n_blocks, indicator.shape[0])
+    targets = np.linspace(0, indicator.nnz, n_blocks + 1)
+    bounds = np.searchsorted(indicator.indptr, targets)
+    bounds[0], bounds[-1] = 0, indicator.shape[0]
+    bounds = np.unique(bounds)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _grouped_sum(indicator, matrix, n_jobs=1):
+    if n_jobs == 1 or indicator.shape[0] < 2:
+        return indicator @ matrix
+
+    # Every collapsed row depends only on the features of its own group, so
+    # blocks of groups can be aggregated independently, and each block only
+    # reads the rows of its own features. The summation order within a group
+    # is unchanged, so the result is bit-identical to the serial product.
+    # scipy runs the sparse product itself with the GIL released, so the
+    # threads only contend for it while slicing and stacking blocks.
+    def _aggregate_block(bounds):
+        start, stop = bounds
+        return indicator[start:stop] @ matrix
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        blocks = list(executor.map(
+            _aggregate_block, _group_blocks(indicator, n_jobs)))
+    return scipy.sparse.vstack(blocks, format='csr')
+
+
+def _frequent_groups(table, group_codes, group_ids, min_frequency):
+    """Drop the groups whose total frequency is below ``min_frequency``.
+
+    Group totals are summed from the per-feature totals, so this needs no
+    aggregation of the table. Features of dropped groups get a group code of
+    -1, and the remaining groups keep their order.
+    """
+    frequencies = np.bincount(group_codes,
+                              weights=table.sum(axis='observation'),
+                              minlength=len(group_ids))
+    keep = frequencies >= min_frequency
+    new_codes = np.cumsum(keep) - 1
+    new_codes[~keep] = -1
+    return new_codes[group_codes], group_ids[keep]
+
+
+def _normalize_samples(data):
+    # Each stored value is divided by the total of its (collapsed) sample.
+    # Samples with a total of zero have no stored values, so they stay empty.
+    data = scipy.sparse.csr_matrix(data, dtype=np.float64)
+    totals = np.bincount(data.indices, weights=data.data,
+                         minlength=data.shape[1])
+    data.data /= totals[data.indices]
+    return data
+
+
+def _aggregate(table, group_codes, group_ids, n_jobs=1,
+               observation_metadata=None, min_samples=0, relative=False):
+    # The input table is only ever read: the collapsed matrix is built
+    # directly from its buffers, and only the (small) sample axis is copied
+    # so that the collapsed table does not share state with its input.
+    n_groups = len(group_ids)
+    indicator = _indicator_matrix(group_codes, n_groups,
+                                  _accumulator_dtype(table.dtype))
+    data = _grouped_sum(indicator, table.matrix_data, n_jobs)
+    if observation_metadata is None:
+        observation_metadata = _collapsed_metadata(
+            table.ids(axis='observation'), group_codes, n_groups)
+    if min_samples > 0:
+        # Groups observed in too few samples are dropped before the
+        # collapsed table is built.
+        data = scipy.sparse.csr_matrix(data)
+        data.eliminate_zeros()
+        keep = np.flatnonzero(np.diff(data.indptr) >= min_samples)
+        data = data[keep]
+        group_ids = group_ids[keep]
+        observation_metadata = [observation_metadata[i] for i in keep]
+    if relative:
+        data = _normalize_samples(data)
+    return biom.Table(
+        data, group_ids, table.ids(axis='sample').copy(),
+        observation_metadata, copy.deepcopy(table.metadata(axis='sample')),
+        table.table_id, type=table.type)
+
+
+def _collapse_table(table, taxonomy, level, n_jobs=1, min_frequency=0,
+                    min_samples=0, relative=False):
+    taxonomy = _align_taxonomy(table, taxonomy)
+
+    if min_frequency > 0 or min_samples > 0 or relative:
+        key = collapse_cache.key(
+            table, taxonomy, (level, min_frequency, min_samples, relative))
+    else:
+        key = collapse_cache.key(table, taxonomy, level)
+    collapsed_table = collapse_cache.get(key)
+    if collapsed_table is None:
+        group_codes, group_ids = taxonomy.groups(level)
+        if min_frequency > 0:
+            group_codes, group_ids = _frequent_groups(
+                table, group_codes, group_ids, min_frequency)
+        collapsed_table = _aggregate(table, group_codes, group_ids, n_jobs,
+                                     min_samples=min_samples,
+                                     relative=relative)
+        collapse_cache.put(key, collapsed_table)
+    return collapsed_table
+
+
+def _collapse_plan(taxonomy, level):
+    """Map every feature of ``taxonomy`` to its lineage at ``level``."""
+    group_codes, group_ids = taxonomy.groups(level)
+    return pd.Series(group_ids[group_codes], index=taxonomy.ids,
+                     name='Taxon').rename_axis('Feature ID')
+
+
+def _apply_collapse_plan(table, plan):
+    # The plan already holds the collapsed lineage of every feature, so the
+    # table is collapsed by factorizing those labels: no lineage is parsed.
+    feature_ids = table.ids(axis='observation')
+    positions = plan.index.get_indexer(feature_ids)
+    _check_missing_ids(feature_ids, positions)
+    group_codes, group_ids = pd.factorize(
+        np.asarray(plan.values, dtype=object)[positions])
+    return _aggregate(table, group_codes, np.asarray(group_ids, dtype=object))
+
+
+def _collapse_presence_absence_table(table, taxonomy, level):
+    """Collapse a presence/absence table with a boolean sparse product.
+
+    A collapsed feature is present in every sample that any of its features
+    is present in. That is the product of the indicator matrix and the
+    table's sparsity pattern, multiplied as booleans (where a sum is a
+    logical OR). The pattern shares the indices of the table, so the only
+    copy of the input is one byte per stored value.
+    """
+    taxonomy = _align_taxonomy(table, taxonomy)
+    group_codes, group_ids = taxonomy.groups(level)
+    n_groups = len(group_ids)
+
+    matrix = table.matrix_data
+    present = scipy.sparse.csr_matrix(
+        (matrix.data != 0, matrix.indices, matrix.indptr), shape=matrix.shape)
+    data = _indicator_matrix(group_codes, n_groups, bool) @ present
+    # features stored as explicit zeros leave explicit False values behind
+    data.eliminate_zeros()
+    # biom.Table stores a float copy of the matrix it is given, so all of the
+    # values are passed as views of a single 1.0: that copy is the only array
+    # of values. (Passing booleans would make the cast re-sort the indices.)
+    data = scipy.sparse.csr_matrix(
+        (np.broadcast_to(1.0, data.nnz), data.indices, data.indptr),
+        shape=data.shape)
+
+    return biom.Table(
+        data, group_ids, table.ids(axis='sample').copy(),
+        _collapsed_metadata(taxonomy.ids, group_codes, n_groups),
+        copy.deepcopy(table.metadata(axis='sample')), table.table_id,
+        type=table.type)
+
+
+def _collapse_tables(tables, taxonomy, levels, n_jobs=1):
+    """Collapse several tables at several levels with one shared grouping.
+
+    ``taxonomy`` must cover the features of every table. The lineages are
+    grouped once per level over all of those features, and each table only
+    re-numbers the groups of its own features (in order of their first
+    appearance, as collapse would). Returns a dict mapping each table name
+    to a list of collapsed tables, one per level.
+    """
+    groupings = [taxonomy.groups(level) for level in levels]
+
+    def _collapse_one(table):
+        positions = taxonomy.get_indexer(table.ids(axis='observation'))
+        _check_missing_ids(table.ids(axis='observation'), positions)
+        collapsed_tables = []
+        for group_codes, group_ids in groupings:
+            table_codes, used = pd.factorize(group_codes[positions])
+            collapsed_tables.append(
+                _aggregate(table, table_codes, group_ids[used]))
+        return collapsed_tables
+
+    names = list(tables)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = executor.map(_collapse_one,
+                               (tables[name] for name in names))
+        return dict(zip(names, results))
+
+
+def _pad_rows(matrix, n_rows):
+    # Appending empty rows to a CSR matrix only extends its indptr.
+    matrix = scipy.sparse.csr_matrix(matrix)
+    indptr = np.concatenate([
+        matrix.indptr,
+        np.full(n_rows - matrix.shape[0], matrix.indptr[-1],
+                dtype=matrix.indptr.dtype)])
+    return scipy.sparse.csr_matrix((matrix.data, matrix.indices, indptr),
+                                   shape=(n_rows, matrix.shape[1]))
+
+
+def _merge_collapsed_metadata(existing, additions):
+    if existing is None:
+        existing = [{}] * len(additions)
+    merged = []
+    for md, added in zip(existing, additions):
+        collapsed_ids = list(md.get('collapsed_ids', []))
+        seen = set(collapsed_ids)
+        collapsed_ids.extend(e for e in added['collapsed_ids']
+                             if e not in seen)
+        merged.append({'collapsed_ids': collapsed_ids})
+    return merged
+
+
+def _append_collapsed(collapsed_table, table, taxonomy, level):
+    """Collapse ``table`` and append its samples to ``collapsed_table``.
+
+    Only ``table`` is collapsed. Its groups are matched to the existing
+    collapsed feature IDs, and groups not seen before are appended after
+    them, so the existing rows keep their order.
+    """
+    overlap = set(collapsed_table.ids(axis='sample')) & \
+        set(table.ids(axis='sample'))
+    if overlap:
+        raise ValueError('Sample IDs found in the table are already present '
+                         'in the collapsed table: {}'.format(overlap))
+
+    taxonomy = _align_taxonomy(table, taxonomy)
+    group_codes, group_ids = taxonomy.groups(level)
+
+    existing_ids = collapsed_table.ids(axis='observation')
+    rows = pd.Index(existing_ids).get_indexer(group_ids)
+    new_groups = rows == -1
+    rows[new_groups] = len(existing_ids) + np.arange(new_groups.sum())
+    observation_ids = np.concatenate(
+        [np.asarray(existing_ids, dtype=object), group_ids[new_groups]])
+    n_rows = len(observation_ids)
+
+    feature_rows = rows[group_codes]
+    dtype = _accumulator_dtype(
+        np.result_type(collapsed_table.dtype, table.dtype))
+    indicator = _indicator_matrix(feature_rows, n_rows, dtype)
+    data = scipy.sparse.hstack(
+        [_pad_rows(collapsed_table.matrix_data, n_rows),
+         indicator @ table.matrix_data], format='csr')
+
+    existing_md = collapsed_table.metadata(axis='observation')
+    if existing_md is not None:
+        existing_md = list(existing_md) + [{}] * new_groups.sum()
+    observation_metadata = _merge_collapsed_metadata(
+        existing_md, _collapsed_metadata(taxonomy.ids, feature_rows, n_rows))
+
+    existing_sample_md = collapsed_table.metadata(axis='sample')
+    added_sample_md = table.metadata(axis='sample')
+    if existing_sample_md is None or added_sample_md is None:
+        sample_metadata = None
+    else:
+        sample_metadata = copy.deepcopy(list(existing_sample_md) +
+                                        list(added_sample_md))
+
+    return biom.Table(
+        data, observation_ids,
+        np.concatenate([collapsed_table.ids(axis='sample'),
+                        table.ids(axis='sample')]),
+        observation_metadata, sample_metadata, collapsed_table.table_id,
+        type=collapsed_table.type)
+
+
+def _hdf5_ids(fp, axis):
+    with h5py.File(fp, 'r') as fh:
+        ids = fh[axis]['ids']
+        if ids.size == 0:
+            return np.array([], dtype=object)
+        return np.asarray(ids.asstr()[:], dtype=object)
+
+
+def _fasta_id(header):
+    # as in scikit-bio, the ID is the header up to its first whitespace
+    fields = header[1:].split(maxsplit=1)
+    return fields[0] if fields else ''
+
+
+def _fasta_ids(fp):
+    """IDs of the records in a FASTA file, in file order."""
+    with open(fp) as fh:
+        return [_fasta_id(line) for line in fh if line.startswith('>')]
+
+
+def _filter_fasta(fp, output_fp, ids):
+    """Copy the records of a FASTA file whose IDs are in ``ids``.
+
+    Records are streamed line by line, and kept records are written out
+    verbatim (headers and line wrapping included), so memory use depends on
+    ``ids`` but not on the sequences.
+    """
+    ids = set(ids)
+    keep = False
+    with open(fp) as fh, open(output_fp, 'w') as output:
+        for line in fh:
+            if line.startswith('>'):
+                keep = _fasta_id(line) in ids
+            if keep:
+                output.write(line)
+
+
+def _iter_hdf5_sample_blocks(fh, block_size):
+    # The sample-major (CSC) copy of the matrix in a BIOM v2.1 file lets each
+    # block of samples be read as one contiguous slice of data and indices.
+    matrix = fh['sample']['matrix']
+    indptr = matrix['indptr'][:]
+    n_features = fh['observation']['ids'].shape[0]
+    n_samples = len(indptr) - 1
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        lo, hi = indptr[start], indptr[stop]
+        yield scipy.sparse.csc_matrix(
+            (matrix['data'][lo:hi], matrix['indices'][lo:hi],
+             indptr[start:stop + 1] - lo),
+            shape=(n_features, stop - start))
+
+
+def _decode_attr(value):
+    if isinstance(value, bytes):
+        return value.decode('utf8')
+    return value
+
+
+def _collapse_hdf5_table(fp, taxonomy, level, block_size):
+    """Collapse a BIOM v2.1 HDF5 file without loading it into memory.
+
+    ``taxonomy`` must be aligned with the file's observation IDs. Samples are
+    read and collapsed ``block_size`` at a time, so peak memory is bounded by
+    one block of the input plus the collapsed output.
+    """
+    group_codes, group_ids = taxonomy.groups(level)
+    n_groups = len(group_ids)
+
+    with h5py.File(fp, 'r') as fh:
+        indicator = _indicator_matrix(
+            group_codes, n_groups,
+            _accumulator_dtype(fh['sample']['matrix']['data'].dtype))
+        blocks = [scipy.sparse.csc_matrix(indicator @ block)
+                  for block in _iter_hdf5_sample_blocks(fh, block_size)]
+        table_id = _decode_attr(fh.attrs.get('id'))
+        table_type = _decode_attr(fh.attrs.get('type'))
+
+    if blocks:
+        data = scipy.sparse.hstack(blocks, format='csc')
+    else:
+        data = scipy.sparse.csc_matrix((n_groups, 0), dtype=indicator.dtype)
+
+    return biom.Table(
+        data, group_ids, _hdf5_ids(fp, 'sample'),
+        _collapsed_metadata(taxonomy.ids, group_codes, n_groups),
+        None, table_id, type=table_type)
+
+
+def _merge_collapse_hdf5_tables(fps, taxonomy, level, block_size,
+                                overlap_method):
+    """Collapse several BIOM v2.1 HDF5 files into one merged table.
+
+    ``taxonomy`` must be aligned with the union of the files' observation IDs,
+    in order of their first appearance. Each file is streamed in blocks of
+    ``block_size`` samples straight into the merged groups, so neither the
+    input tables nor their merged (uncollapsed) table are ever held in memory.
+    Samples present in more than one file are either rejected or summed,
+    depending on ``overlap_method``.
+    """
+    sample_ids = np.concatenate([_hdf5_ids(fp, 'sample') for fp in fps])
+    sample_codes, unique_sample_ids = pd.factorize(sample_ids)
+    if (len(unique_sample_ids) < len(sample_ids) and
+            overlap_method == 'error_on_overlapping_sample'):
+        overlap = pd.Index(sample_ids)
+        raise ValueError('Some samples are present in more than one table: '
+                         '{}'.format(set(overlap[overlap.duplicated()])))
+
+    group_codes, group_ids = taxonomy.groups(level)
+    n_groups = len(group_ids)
+
+    blocks = []
+    table_type = None
+    for fp in fps:
+        feature_codes = group_codes[
+            taxonomy.get_indexer(_hdf5_ids(fp, 'observation'))]
+        with h5py.File(fp, 'r') as fh:
+            indicator = _indicator_matrix(
+                feature_codes, n_groups,
+                _accumulator_dtype(fh['sample']['matrix']['data'].dtype))
+            blocks.extend(scipy.sparse.csc_matrix(indicator @ block)
+                          for block in _iter_hdf5_sample_blocks(fh,
+                                                                block_size))
+            if table_type is None:
+                table_type = _decode_attr(fh.attrs.get('type'))
+
+    if blocks:
+        data = scipy.sparse.hstack(blocks, format='csc')
+    else:
+        data = scipy.sparse.csc_matrix((n_groups, 0), dtype=np.float64)
+
+    if len(unique_sample_ids) < len(sample_ids):
+        data = data @ _indicator_matrix(
+            sample_codes, len(unique_sample_ids), data.dtype).T
+
+    return biom.Table(
+        data, group_ids, np.asarray(unique_sample_ids, dtype=object),
+        _collapsed_metadata(taxonomy.ids, group_codes, n_groups),
+        None, type=table_type)
+
+
+def _collapse_levels(table, taxonomy, levels, n_jobs=1):
+    """Collapse ``table`` at each of ``levels`` with one hierarchical pass.
+
+    The table is collapsed once at the deepest level, then each shallower
+    level is derived from the (much smaller) level below it. Levels that are
+    already in the collapse cache are reused. Returns a dict mapping each
+    level to its collapsed table.
+    """
+    taxonomy = _align_taxonomy(table, taxonomy)
+
+    inputs_key = collapse_cache.inputs_key(table, taxonomy)
+    # A rolled-up level equals the direct collapse that the cache holds for
+    # that level only when no sum is rounded, so rolled-up levels of other
+    # tables are neither read from nor written to the cache.
+    share_rollups = (inputs_key is not None and
+                     _sums_exactly(table.matrix_data.data))
+    collapsed_tables = {}
+    collapsed_table = None
+    child_codes = None
+    for level in sorted(set(levels), reverse=True):
+        group_codes, group_ids = taxonomy.groups(level)
+        key = collapse_cache.level_key(inputs_key, level)
+        if collapsed_table is not None and not share_rollups:
+            key = None
+        cached = collapse_cache.get(key)
+        if cached is not None:
+            collapsed_table = cached
+        elif collapsed_table is None:
+            collapsed_table = _aggregate(table, group_codes, group_ids,
+                                         n_jobs)
+            collapse_cache.put(key, collapsed_table)
+        else:
+            child_to_parent = np.empty(collapsed_table.shape[0],
+                                       dtype=np.intp)
+            child_to_parent[child_codes] = group_codes
+            collapsed_table = _aggregate(
+                collapsed_table, child_to_parent, group_ids,
+                observation_metadata=_collapsed_metadata(
+                    taxonomy.ids, group_codes, len(group_ids)))
+            # Rolling a level up from the one below is cheaper than loading
+            # it from disk.
+            collapse_cache.put(key, collapsed_table, persist=False)
+        collapsed_tables[level] = collapsed_table
+        child_codes = group_codes
 
     return collapsed_tables
 
 
+def _extract_to_level(taxonomy, table):
+    taxonomy = _align_taxonomy(table, taxonomy)
+    levels = range(1, taxonomy.max_level + 1)
+    collapsed_tables = _collapse_levels(table, taxonomy, levels)
+    return [_biom_to_df(collapsed_tables[level]) for level in levels]
+
+
 def _biom_to_df(table):
-    return table.transpose().to_dataframe(dense=True)
+    # biom stores every table as float64. Count tables are densified with
+    # the most compact integer dtype that holds their values instead.
+    matrix = table.matrix_data
+    dtype = _compact_dtype(matrix.data)
+    return pd.DataFrame(matrix.T.astype(dtype).toarray(),
+                        index=table.ids(axis='sample'),
+                        columns=table.ids(axis='observation'))
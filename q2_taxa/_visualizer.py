@@ -17,7 +17,8 @@ import q2templates
 
 from qiime2 import Metadata
 
-from ._util import _extract_to_level, _biom_to_df
+from ._util import (_extract_to_level, _biom_to_df, _get_max_level,
+                    _index_taxonomy)
 
 
 TEMPLATES = pkg_resources.resource_filename('q2_taxa', 'assets')
@@ -48,6 +49,8 @@ def barplot(output_dir: str, table: biom.Table, taxonomy: pd.Series = None,
     metadata = metadata.to_dataframe()
     jsonp_files, csv_files = [], []
     if collapse:
+        taxonomy = _index_taxonomy(table.ids(axis='observation'), taxonomy,
+                                   _get_max_level(taxonomy))
         collapsed_tables = _extract_to_level(taxonomy, table)
     else:
         collapsed_tables = [_biom_to_df(table)]
@@ -11,12 +11,20 @@ import qiime2.plugin
 import q2_taxa
 
 from q2_types.feature_data import FeatureData, Taxonomy, Sequence
-from q2_types.feature_table import FeatureTable, Frequency, PresenceAbsence
+from q2_types.feature_table import (FeatureTable, Frequency, PresenceAbsence,
+                                    RelativeFrequency)
 
-from . import barplot, collapse, filter_table, filter_seqs
+from . import (barplot, collapse, collapse_batch, collapse_incremental,
+               collapse_levels, collapse_merge, collapse_plan,
+               collapse_presence_absence, collapse_streaming,
+               collapse_with_plan, filter_table, filter_seqs)
 import q2_taxa._examples as ex
 
 T1 = qiime2.plugin.TypeMatch([Frequency, PresenceAbsence])
+P_relative, T_collapsed = qiime2.plugin.TypeMap({
+    qiime2.plugin.Bool % qiime2.plugin.Choices(False): Frequency,
+    qiime2.plugin.Bool % qiime2.plugin.Choices(True): RelativeFrequency,
+})
 
 plugin = qiime2.plugin.Plugin(
     name='taxa',
@@ -36,8 +44,17 @@ plugin.methods.register_function(
         'taxonomy': FeatureData[Taxonomy],
         'table': FeatureTable[Frequency]
     },
-    parameters={'level': qiime2.plugin.Int},
-    outputs=[('collapsed_table', FeatureTable[Frequency])],
+    parameters={'level': qiime2.plugin.Int,
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table']),
+                'n_jobs': qiime2.plugin.Int % qiime2.plugin.Range(1, None),
+                'min_frequency': qiime2.plugin.Int % qiime2.plugin.Range(
+                    0, None),
+                'min_samples': qiime2.plugin.Int % qiime2.plugin.Range(
+                    0, None),
+                'relative': P_relative},
+    outputs=[('collapsed_table', FeatureTable[T_collapsed])],
     input_descriptions={
         'taxonomy': ('Taxonomic annotations for features in the provided '
                      'feature table. All features in the feature table must '
@@ -48,7 +65,27 @@ plugin.methods.register_function(
     parameter_descriptions={
         'level': ('The taxonomic level at which the features should be '
                   'collapsed. All ouput features will have exactly '
-                  'this many levels of taxonomic annotation.')
+                  'this many levels of taxonomic annotation.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in the feature table. In both cases '
+                             'only the annotations of features present in '
+                             'the feature table are parsed and collapsed.'),
+        'n_jobs': ('The number of threads to use. The collapsed features '
+                   'are split into this many blocks, each covering about the '
+                   'same number of input features, which are aggregated in '
+                   'parallel.'),
+        'min_frequency': ('The minimum total frequency that a collapsed '
+                          'feature must have to be retained. Collapsed '
+                          'features below this frequency are never built.'),
+        'min_samples': ('The minimum number of samples that a collapsed '
+                        'feature must be observed in to be retained.'),
+        'relative': ('Convert the collapsed frequencies to relative '
+                     'frequencies within each sample, producing a '
+                     'FeatureTable[RelativeFrequency]. Relative frequencies '
+                     'are computed over the retained collapsed features.')
     },
     output_descriptions={
         'collapsed_table': ('The resulting feature table, where all features '
@@ -64,6 +101,356 @@ plugin.methods.register_function(
     },
 )
 
+plugin.methods.register_function(
+    function=collapse_plan,
+    inputs={
+        'taxonomy': FeatureData[Taxonomy],
+        'table': FeatureTable[Frequency]
+    },
+    parameters={'level': qiime2.plugin.Int,
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table'])},
+    outputs=[('plan', FeatureData[Taxonomy])],
+    input_descriptions={
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature table. All features in the feature table must '
+                     'have a corresponding taxonomic annotation. Taxonomic '
+                     'annotations that are not present in the feature table '
+                     'will be ignored.'),
+        'table': ('Feature table whose features the collapse plan should '
+                  'cover.')},
+    parameter_descriptions={
+        'level': ('The taxonomic level at which the features should be '
+                  'collapsed. All ouput features will have exactly '
+                  'this many levels of taxonomic annotation.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in the feature table.')
+    },
+    output_descriptions={
+        'plan': ('The collapse plan: the taxonomic annotation of each feature '
+                 'in the feature table, truncated (or padded) to the '
+                 'user-specified number of levels.')
+    },
+    name='Compute a reusable plan for collapsing features by their taxonomy',
+    description='Compute the collapsed taxonomic annotation of every feature '
+                'in the feature table at the specified level. The resulting '
+                'plan can be passed to collapse-with-plan to collapse this '
+                'feature table, or any feature table whose features it '
+                'covers, without parsing the taxonomy again.'
+)
+
+plugin.methods.register_function(
+    function=collapse_with_plan,
+    inputs={
+        'table': FeatureTable[Frequency],
+        'plan': FeatureData[Taxonomy]
+    },
+    parameters={},
+    outputs=[('collapsed_table', FeatureTable[Frequency])],
+    input_descriptions={
+        'table': 'Feature table to be collapsed.',
+        'plan': ('A collapse plan computed by collapse-plan. All features in '
+                 'the feature table must be covered by the plan.')},
+    parameter_descriptions={},
+    output_descriptions={
+        'collapsed_table': ('The resulting feature table, where all features '
+                            'are now the taxonomic annotations of the plan.')
+    },
+    name='Collapse features by a precomputed collapse plan',
+    description='Collapse groups of features that are assigned the same '
+                'taxonomic annotation by the collapse plan. The frequencies '
+                'of all features will be summed when they are collapsed, and '
+                'the result is the same as running collapse with the '
+                'taxonomy and level that the plan was computed from.'
+)
+
+plugin.methods.register_function(
+    function=collapse_levels,
+    inputs={
+        'taxonomy': FeatureData[Taxonomy],
+        'table': FeatureTable[Frequency]
+    },
+    parameters={'levels': qiime2.plugin.List[qiime2.plugin.Int],
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table']),
+                'n_jobs': qiime2.plugin.Int % qiime2.plugin.Range(1, None)},
+    outputs=[('collapsed_tables',
+              qiime2.plugin.Collection[FeatureTable[Frequency]])],
+    input_descriptions={
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature table. All features in the feature table must '
+                     'have a corresponding taxonomic annotation. Taxonomic '
+                     'annotations that are not present in the feature table '
+                     'will be ignored.'),
+        'table': 'Feature table to be collapsed.'},
+    parameter_descriptions={
+        'levels': ('The taxonomic levels at which the features should be '
+                   'collapsed.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in the feature table.'),
+        'n_jobs': ('The number of threads to use when collapsing the feature '
+                   'table at the deepest requested level.')
+    },
+    output_descriptions={
+        'collapsed_tables': ('The collapsed feature tables, one per level, '
+                             'keyed as "level-<level>".')
+    },
+    name='Collapse features by their taxonomy at several levels',
+    description='Collapse groups of features that have the same taxonomic '
+                'assignment through each of the specified levels, as collapse '
+                'would. The taxonomy is parsed once, and the feature table is '
+                'only collapsed at the deepest requested level: each '
+                'shallower level is derived from the collapsed table of the '
+                'level below it.'
+)
+
+plugin.methods.register_function(
+    function=collapse_batch,
+    inputs={
+        'taxonomy': FeatureData[Taxonomy],
+        'tables': qiime2.plugin.Collection[FeatureTable[Frequency]]
+    },
+    parameters={'levels': qiime2.plugin.List[qiime2.plugin.Int],
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table']),
+                'n_jobs': qiime2.plugin.Int % qiime2.plugin.Range(1, None)},
+    outputs=[('collapsed_tables',
+              qiime2.plugin.Collection[FeatureTable[Frequency]])],
+    input_descriptions={
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature tables. All features in the feature tables '
+                     'must have a corresponding taxonomic annotation. '
+                     'Taxonomic annotations that are not present in any of '
+                     'the feature tables will be ignored.'),
+        'tables': 'Feature tables to be collapsed.'},
+    parameter_descriptions={
+        'levels': ('The taxonomic levels at which the features should be '
+                   'collapsed. Each feature table is collapsed at every '
+                   'level.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in any of the feature tables.'),
+        'n_jobs': ('The number of threads to use. Feature tables are '
+                   'collapsed in parallel.')
+    },
+    output_descriptions={
+        'collapsed_tables': ('The collapsed feature tables. Each table is '
+                             'keyed by the key of the input feature table '
+                             'and the level, as "<key>-level-<level>".')
+    },
+    name='Collapse many feature tables by their taxonomy',
+    description='Collapse each of the provided feature tables at each of the '
+                'specified levels, as collapse would. The taxonomy is parsed '
+                'and its lineages grouped only once for all of the feature '
+                'tables.'
+)
+
+plugin.methods.register_function(
+    function=collapse_streaming,
+    inputs={
+        'taxonomy': FeatureData[Taxonomy],
+        'table': FeatureTable[Frequency]
+    },
+    parameters={'level': qiime2.plugin.Int,
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table']),
+                'block_size': qiime2.plugin.Int % qiime2.plugin.Range(
+                    1, None)},
+    outputs=[('collapsed_table', FeatureTable[Frequency])],
+    input_descriptions={
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature table. All features in the feature table must '
+                     'have a corresponding taxonomic annotation. Taxonomic '
+                     'annotations that are not present in the feature table '
+                     'will be ignored.'),
+        'table': 'Feature table to be collapsed.'},
+    parameter_descriptions={
+        'level': ('The taxonomic level at which the features should be '
+                  'collapsed. All ouput features will have exactly '
+                  'this many levels of taxonomic annotation.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in the feature table.'),
+        'block_size': ('The number of samples read from the feature table '
+                       'and collapsed at a time. Smaller blocks reduce peak '
+                       'memory usage.')
+    },
+    output_descriptions={
+        'collapsed_table': ('The resulting feature table, where all features '
+                            'are now taxonomic annotations with the '
+                            'user-specified number of levels.')
+    },
+    name=('Collapse features by their taxonomy at the specified level, '
+          'streaming the feature table from disk'),
+    description='Collapse groups of features that have the same taxonomic '
+                'assignment through the specified level. The frequencies of '
+                'all features will be summed when they are collapsed. Unlike '
+                'collapse, the feature table is never loaded into memory as a '
+                'whole: it is read from disk and collapsed in blocks of '
+                'samples, so this method can be used on feature tables that '
+                'are larger than the available memory.'
+)
+
+plugin.methods.register_function(
+    function=collapse_merge,
+    inputs={
+        'taxonomy': FeatureData[Taxonomy],
+        'tables': qiime2.plugin.List[FeatureTable[Frequency]]
+    },
+    parameters={'level': qiime2.plugin.Int,
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table']),
+                'overlap_method':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['error_on_overlapping_sample', 'sum']),
+                'block_size': qiime2.plugin.Int % qiime2.plugin.Range(
+                    1, None)},
+    outputs=[('collapsed_table', FeatureTable[Frequency])],
+    input_descriptions={
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature tables. All features in the feature tables '
+                     'must have a corresponding taxonomic annotation. '
+                     'Taxonomic annotations that are not present in any of '
+                     'the feature tables will be ignored.'),
+        'tables': 'Feature tables to be merged and collapsed.'},
+    parameter_descriptions={
+        'level': ('The taxonomic level at which the features should be '
+                  'collapsed. All ouput features will have exactly '
+                  'this many levels of taxonomic annotation.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in any of the feature tables.'),
+        'overlap_method': ('Method for handling samples that are present in '
+                           'more than one feature table. '
+                           '"error_on_overlapping_sample" fails, while "sum" '
+                           'sums the collapsed frequencies of the sample '
+                           'across the feature tables.'),
+        'block_size': ('The number of samples read from a feature table and '
+                       'collapsed at a time. Smaller blocks reduce peak '
+                       'memory usage.')
+    },
+    output_descriptions={
+        'collapsed_table': ('The merged feature table, where all features '
+                            'are now taxonomic annotations with the '
+                            'user-specified number of levels.')
+    },
+    name='Merge feature tables and collapse them by their taxonomy',
+    description='Merge the provided feature tables and collapse groups of '
+                'features that have the same taxonomic assignment through the '
+                'specified level, as merging the feature tables and then '
+                'running collapse would. The feature tables are streamed from '
+                'disk one block of samples at a time and collapsed directly '
+                'into the merged table, so the merged feature table is never '
+                'created and peak memory depends on the number of collapsed '
+                'features rather than the number of input features.'
+)
+
+plugin.methods.register_function(
+    function=collapse_incremental,
+    inputs={
+        'collapsed_table': FeatureTable[Frequency],
+        'taxonomy': FeatureData[Taxonomy],
+        'table': FeatureTable[Frequency]
+    },
+    parameters={'level': qiime2.plugin.Int,
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table'])},
+    outputs=[('updated_table', FeatureTable[Frequency])],
+    input_descriptions={
+        'collapsed_table': ('A feature table that was previously collapsed '
+                            'at the same level. Its samples must not be '
+                            'present in the feature table.'),
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature table. All features in the feature table must '
+                     'have a corresponding taxonomic annotation. Taxonomic '
+                     'annotations that are not present in the feature table '
+                     'will be ignored.'),
+        'table': ('Feature table containing only the new samples, to be '
+                  'collapsed and added to the collapsed table.')},
+    parameter_descriptions={
+        'level': ('The taxonomic level at which the features should be '
+                  'collapsed. This must be the level at which the collapsed '
+                  'table was collapsed.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in the feature table.')
+    },
+    output_descriptions={
+        'updated_table': ('The collapsed table with the collapsed new '
+                          'samples added. Features of the collapsed table '
+                          'keep their order, and taxa that were not present '
+                          'in it are added after them.')
+    },
+    name='Add new samples to a collapsed feature table',
+    description='Collapse a feature table containing only new samples, as '
+                'collapse would, and add the result to a previously '
+                'collapsed feature table. Only the new samples are '
+                'collapsed, so the cost of the update depends on the new '
+                'data rather than on the size of the collapsed table.'
+)
+
+plugin.methods.register_function(
+    function=collapse_presence_absence,
+    inputs={
+        'taxonomy': FeatureData[Taxonomy],
+        'table': FeatureTable[PresenceAbsence]
+    },
+    parameters={'level': qiime2.plugin.Int,
+                'max_level_source':
+                    qiime2.plugin.Str % qiime2.plugin.Choices(
+                        ['taxonomy', 'table'])},
+    outputs=[('collapsed_table', FeatureTable[PresenceAbsence])],
+    input_descriptions={
+        'taxonomy': ('Taxonomic annotations for features in the provided '
+                     'feature table. All features in the feature table must '
+                     'have a corresponding taxonomic annotation. Taxonomic '
+                     'annotations that are not present in the feature table '
+                     'will be ignored.'),
+        'table': 'Presence/absence feature table to be collapsed.'},
+    parameter_descriptions={
+        'level': ('The taxonomic level at which the features should be '
+                  'collapsed. All ouput features will have exactly '
+                  'this many levels of taxonomic annotation.'),
+        'max_level_source': ('Determines how the maximum level available in '
+                             'the taxonomy data is computed. "taxonomy" uses '
+                             'every annotation in the provided taxonomy; '
+                             '"table" uses only the annotations of features '
+                             'present in the feature table.')
+    },
+    output_descriptions={
+        'collapsed_table': ('The resulting presence/absence feature table, '
+                            'where all features are now taxonomic '
+                            'annotations with the user-specified number of '
+                            'levels.')
+    },
+    name=('Collapse presence/absence features by their taxonomy at the '
+          'specified level'),
+    description='Collapse groups of features that have the same taxonomic '
+                'assignment through the specified level. A collapsed '
+                'feature is present in a sample if any of the features that '
+                'were collapsed into it are present in that sample.'
+)
+
 plugin.methods.register_function(
     function=filter_table,
     inputs={
@@ -74,8 +461,9 @@ plugin.methods.register_function(
                 'exclude': qiime2.plugin.Str,
                 'mode':
                     qiime2.plugin.Str % qiime2.plugin.Choices(
-                        ['exact', 'contains']),
-                'query_delimiter': qiime2.plugin.Str},
+                        ['exact', 'contains', 'rank', 'regex']),
+                'query_delimiter': qiime2.plugin.Str,
+                'query': qiime2.plugin.Str},
     outputs=[('filtered_table', FeatureTable[T1])],
     input_descriptions={
         'taxonomy': ('Taxonomic annotations for features in the provided '
@@ -98,12 +486,31 @@ plugin.methods.register_function(
         'mode': ('Mode for determining if a search term matches a taxonomic '
                  'annotation. "contains" requires that the annotation '
                  'has the term as a substring; "exact" requires that the '
-                 'annotation is a perfect match to a search term.'),
+                 'annotation is a perfect match to a search term; "rank" '
+                 'requires that a single rank of the annotation matches a '
+                 'search term of the form <rank>:<name>. <rank> is either a '
+                 'rank prefix (e.g. "g__:Bacteroides" matches the rank '
+                 '"g__Bacteroides" at any level) or a level number (e.g. '
+                 '"6:g__Bacteroides" matches it only at the sixth level); '
+                 '"regex" requires that a search term, as a Python regular '
+                 'expression, matches somewhere in the annotation (the '
+                 'query-delimiter may need to be changed for expressions '
+                 'that contain a comma).'),
         'query_delimiter': ('The string used to delimit multiple search terms '
                             'provided to include or exclude. This parameter '
                             'should only need to be modified if the default '
                             'delimiter (a comma) is used in the provided '
-                            'taxonomic annotations.')
+                            'taxonomic annotations.'),
+        'query': ('A boolean expression of search terms that indicates which '
+                  'taxa should be retained, e.g. "(Bacteria AND NOT '
+                  'Chloroplast) OR Archaea". Terms are combined with AND, OR, '
+                  'NOT and parentheses. Terms containing spaces, parentheses '
+                  'or double quotes must be double-quoted (with \\ escaping '
+                  'the next character). Each term is matched using mode, '
+                  'unless it is prefixed with the mode to use, e.g. '
+                  '"rank:g__:Bacteroides" or \'regex:"^d__Archaea"\'. If '
+                  'include or exclude are also provided, the query is applied '
+                  'after them.')
     },
     output_descriptions={
         'filtered_table': ('The taxonomy-filtered feature table.')
@@ -115,8 +522,9 @@ plugin.methods.register_function(
                  'terms, and can be filtered out of the resulting table by '
                  'specifying one or more exclude search terms. If both '
                  'include and exclude are provided, the inclusion critera '
-                 'will be applied before the exclusion critera. Either '
-                 'include or exclude terms (or both) must be provided. Any '
+                 'will be applied before the exclusion critera. More complex '
+                 'criteria can be given as a boolean query. At least one of '
+                 'include, exclude or query must be provided. Any '
                  'samples that have a total frequency of zero after filtering '
                  'will be removed from the resulting table.')
 )
@@ -131,8 +539,9 @@ plugin.methods.register_function(
                 'exclude': qiime2.plugin.Str,
                 'mode':
                     qiime2.plugin.Str % qiime2.plugin.Choices(
-                        ['exact', 'contains']),
-                'query_delimiter': qiime2.plugin.Str},
+                        ['exact', 'contains', 'rank', 'regex']),
+                'query_delimiter': qiime2.plugin.Str,
+                'query': qiime2.plugin.Str},
     outputs=[('filtered_sequences', FeatureData[Sequence])],
     input_descriptions={
         'taxonomy': ('Taxonomic annotations for features in the provided '
@@ -155,12 +564,31 @@ plugin.methods.register_function(
         'mode': ('Mode for determining if a search term matches a taxonomic '
                  'annotation. "contains" requires that the annotation '
                  'has the term as a substring; "exact" requires that the '
-                 'annotation is a perfect match to a search term.'),
+                 'annotation is a perfect match to a search term; "rank" '
+                 'requires that a single rank of the annotation matches a '
+                 'search term of the form <rank>:<name>. <rank> is either a '
+                 'rank prefix (e.g. "g__:Bacteroides" matches the rank '
+                 '"g__Bacteroides" at any level) or a level number (e.g. '
+                 '"6:g__Bacteroides" matches it only at the sixth level); '
+                 '"regex" requires that a search term, as a Python regular '
+                 'expression, matches somewhere in the annotation (the '
+                 'query-delimiter may need to be changed for expressions '
+                 'that contain a comma).'),
         'query_delimiter': ('The string used to delimit multiple search terms '
                             'provided to include or exclude. This parameter '
                             'should only need to be modified if the default '
                             'delimiter (a comma) is used in the provided '
-                            'taxonomic annotations.')
+                            'taxonomic annotations.'),
+        'query': ('A boolean expression of search terms that indicates which '
+                  'taxa should be retained, e.g. "(Bacteria AND NOT '
+                  'Chloroplast) OR Archaea". Terms are combined with AND, OR, '
+                  'NOT and parentheses. Terms containing spaces, parentheses '
+                  'or double quotes must be double-quoted (with \\ escaping '
+                  'the next character). Each term is matched using mode, '
+                  'unless it is prefixed with the mode to use, e.g. '
+                  '"rank:g__:Bacteroides" or \'regex:"^d__Archaea"\'. If '
+                  'include or exclude are also provided, the query is applied '
+                  'after them.')
     },
     output_descriptions={
         'filtered_sequences': ('The taxonomy-filtered feature sequences.')
@@ -172,8 +600,9 @@ plugin.methods.register_function(
                  'terms, and can be filtered out of the result by '
                  'specifying one or more exclude search terms. If both '
                  'include and exclude are provided, the inclusion critera '
-                 'will be applied before the exclusion critera. Either '
-                 'include or exclude terms (or both) must be provided.')
+                 'will be applied before the exclusion critera. More complex '
+                 'criteria can be given as a boolean query. At least one of '
+                 'include, exclude or query must be provided.')
 )
 
 plugin.visualizers.register_function(
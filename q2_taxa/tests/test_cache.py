@@ -0,0 +1,321 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import scipy.sparse
+
+from q2_taxa._cache import (CACHE_DIR_ENV, CACHE_SIZE_ENV,
+                            _cached_search_index, _cached_taxonomy_index,
+                            collapse_cache)
+from q2_taxa._taxonomy import TaxonomyIndex
+from q2_taxa._util import (_biom_to_df, _collapse_levels, _collapse_table,
+                           _extract_to_level, _index_taxonomy)
+
+
+class CachedTaxonomyIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.taxonomy = pd.Series(['a; b; c', 'a; d', 'a; b; c'],
+                                  index=['feat1', 'feat2', 'feat3'])
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def _entries(self):
+        return sorted(e for e in os.listdir(self.cache_dir.name)
+                      if e.startswith('taxonomy-'))
+
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV: ''}):
+            self.assertIsNone(_cached_taxonomy_index(self.taxonomy))
+
+    def test_miss_then_hit(self):
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name}):
+            compiled = _cached_taxonomy_index(self.taxonomy)
+            self.assertEqual(len(self._entries()), 1)
+
+            cached = _cached_taxonomy_index(self.taxonomy)
+            self.assertEqual(len(self._entries()), 1)
+
+        self.assertIsInstance(cached.ranks, np.memmap)
+        npt.assert_array_equal(cached.ids, compiled.ids)
+        npt.assert_array_equal(cached.lineages, compiled.lineages)
+        npt.assert_array_equal(cached.ranks, compiled.ranks)
+        for level in (1, 2, 3):
+            exp_codes, exp_labels = compiled.groups(level)
+            obs_codes, obs_labels = cached.groups(level)
+            npt.assert_array_equal(obs_codes, exp_codes)
+            npt.assert_array_equal(obs_labels, exp_labels)
+
+    def test_keyed_by_content(self):
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name}):
+            _cached_taxonomy_index(self.taxonomy)
+            _cached_taxonomy_index(self.taxonomy.copy())
+            self.assertEqual(len(self._entries()), 1)
+
+            other = self.taxonomy.copy()
+            other['feat2'] = 'a; e'
+            _cached_taxonomy_index(other)
+            self.assertEqual(len(self._entries()), 2)
+
+    def test_lru_eviction(self):
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name}):
+            _cached_taxonomy_index(self.taxonomy)
+            (first,) = self._entries()
+            entry_size = sum(
+                e.stat().st_size for e in
+                os.scandir(os.path.join(self.cache_dir.name, first)))
+
+        other = pd.Series(['e; f'], index=['feat4'])
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name,
+                              CACHE_SIZE_ENV: str(entry_size)}):
+            os.utime(os.path.join(self.cache_dir.name, first), (0, 0))
+            _cached_taxonomy_index(other)
+
+            self.assertEqual(len(self._entries()), 1)
+            self.assertNotIn(first, self._entries())
+
+    def test_small_subsets_skip_cache(self):
+        taxonomy = pd.Series(['a; b%d' % i for i in range(100)],
+                             index=['feat%d' % i for i in range(100)])
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name}):
+            index = _index_taxonomy(['feat3', 'feat7'], taxonomy)
+            self.assertEqual(self._entries(), [])
+            npt.assert_array_equal(index.lineages, ['a; b3', 'a; b7'])
+
+            _index_taxonomy(['feat%d' % i for i in range(5)], taxonomy)
+            self.assertEqual(len(self._entries()), 1)
+
+    def test_hit_memory_maps_without_parsing(self):
+        taxonomy = pd.Series(['a; b%d; c%d' % (i % 3, i) for i in range(100)],
+                             index=['feat%d' % i for i in range(100)])
+        feature_ids = ['feat%d' % i for i in range(0, 100, 4)]
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name}), \
+                mock.patch.object(TaxonomyIndex, 'from_series',
+                                  wraps=TaxonomyIndex.from_series) as parse:
+            expected = _index_taxonomy(feature_ids, taxonomy)
+            self.assertEqual(parse.call_count, 1)
+
+            # every action call gets a fresh series
+            index = _cached_taxonomy_index(taxonomy.copy())
+            actual = _index_taxonomy(feature_ids, taxonomy.copy())
+            self.assertEqual(parse.call_count, 1)
+
+        for array in (index._ids, index._sorted_ids, index._id_order,
+                      index._lineages):
+            self.assertIsInstance(array, np.memmap)
+        npt.assert_array_equal(actual.ids, expected.ids)
+        npt.assert_array_equal(actual.lineages, expected.lineages)
+        npt.assert_array_equal(actual.groups(2)[0], expected.groups(2)[0])
+
+
+class CachedSearchIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.taxonomy = pd.Series(
+            ['k__Bacteria; p__Firmicutes', 'k__Bacteria; p__Bacteroidetes',
+             'k__Archaea; p__Euryarchaeota', 'k__Bacteria; p__Firmicutes'],
+            index=['feat1', 'feat2', 'feat3', 'feat4'])
+        self.lineages = TaxonomyIndex.from_series(self.taxonomy).lineages
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def _entries(self):
+        return sorted(e for e in os.listdir(self.cache_dir.name)
+                      if e.startswith('search-'))
+
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV: ''}):
+            self.assertIsNone(_cached_search_index(self.taxonomy,
+                                                   self.lineages))
+
+    def test_miss_then_hit(self):
+        with mock.patch.dict(os.environ,
+                             {CACHE_DIR_ENV: self.cache_dir.name}):
+            built = _cached_search_index(self.taxonomy, self.lineages)
+            self.assertEqual(len(self._entries()), 1)
+
+            cached = _cached_search_index(self.taxonomy, self.lineages)
+            self.assertEqual(len(self._entries()), 1)
+
+        self.assertIsInstance(cached.postings, np.memmap)
+        for terms in (['firmicutes'], ['Bacteria', 'arch'], ['p__%oid']):
+            npt.assert_array_equal(cached.match(terms, 'contains'),
+                                   built.match(terms, 'contains'))
+        npt.assert_array_equal(
+            cached.match(['k__Bacteria', 'firmicutes'], 'contains'),
+            [True, True, False])
+
+
+class CollapseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.patch = mock.patch.dict(os.environ,
+                                     {CACHE_DIR_ENV: self.cache_dir.name})
+        self.patch.start()
+        collapse_cache.clear()
+        self.table = biom.Table(np.array([[2.0, 0.0, 1.0],
+                                          [1.0, 1.0, 0.0],
+                                          [9.0, 8.0, 3.0]]),
+                                ['feat1', 'feat2', 'feat3'],
+                                ['A', 'B', 'C'])
+        self.taxonomy = TaxonomyIndex.from_series(
+            pd.Series(['a; b; c', 'a; d', 'a; b; e'],
+                      index=['feat1', 'feat2', 'feat3']))
+
+    def tearDown(self):
+        collapse_cache.clear()
+        self.patch.stop()
+        self.cache_dir.cleanup()
+
+    def test_memory_hit(self):
+        expected = _collapse_table(self.table, self.taxonomy, 2)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (0, 1))
+
+        actual = _collapse_table(self.table, self.taxonomy, 2)
+        self.assertEqual(collapse_cache.memory_hits, 1)
+        self.assertIsNot(actual, expected)
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat3']},
+                          {'collapsed_ids': ['feat2']}))
+
+    def test_disk_hit(self):
+        expected = _collapse_table(self.table, self.taxonomy, 3)
+        collapse_cache.clear()
+
+        actual = _collapse_table(self.table, self.taxonomy, 3)
+        self.assertEqual((collapse_cache.disk_hits, collapse_cache.misses),
+                         (1, 0))
+        self.assertEqual(actual, expected)
+
+    def test_modified_results_leave_cache_unchanged(self):
+        expected = _collapse_table(self.table, self.taxonomy, 2)
+        self.assertEqual(expected.shape, (2, 3))
+
+        expected.filter(['A'], inplace=True)
+        expected.del_metadata()
+        actual = _collapse_table(self.table, self.taxonomy, 2)
+        self.assertEqual(collapse_cache.memory_hits, 1)
+        self.assertEqual(actual.shape, (2, 3))
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat3']},
+                          {'collapsed_ids': ['feat2']}))
+
+        actual.norm(inplace=True)
+        for level, collapsed in _collapse_levels(self.table, self.taxonomy,
+                                                 [2, 3]).items():
+            collapsed.filter(['A'], inplace=True)
+        collapsed_tables = _collapse_levels(self.table, self.taxonomy, [2, 3])
+        self.assertEqual(collapse_cache.memory_hits, 4)
+        self.assertEqual(collapsed_tables[2].shape, (2, 3))
+        self.assertEqual(collapsed_tables[3].shape, (3, 3))
+        npt.assert_array_equal(collapsed_tables[2].matrix_data.toarray(),
+                               [[11.0, 8.0, 4.0], [1.0, 1.0, 0.0]])
+
+    def test_keyed_by_level_and_content(self):
+        _collapse_table(self.table, self.taxonomy, 1)
+        _collapse_table(self.table, self.taxonomy, 2)
+        other = self.table.copy()
+        other.transform(lambda v, i, md: v * 2)
+        _collapse_table(other, self.taxonomy, 1)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (0, 3))
+
+    def test_extract_to_level_reuses_levels(self):
+        expected = _collapse_table(self.table, self.taxonomy, 2)
+
+        actual = _extract_to_level(self.taxonomy, self.table)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (1, 3))
+        pdt.assert_frame_equal(actual[1], _biom_to_df(expected))
+
+        # every level is now cached, with the same metadata as a collapse
+        for level in (1, 2, 3):
+            cached = _collapse_table(self.table, self.taxonomy, level)
+            with mock.patch.dict(os.environ, {CACHE_DIR_ENV: ''}):
+                expected = _collapse_table(self.table, self.taxonomy, level)
+            self.assertEqual(cached, expected)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (4, 3))
+
+        # but the rolled-up level is only kept in memory
+        collapse_cache.clear()
+        for level in (1, 2, 3):
+            _collapse_table(self.table, self.taxonomy, level)
+        self.assertEqual((collapse_cache.disk_hits, collapse_cache.misses),
+                         (2, 1))
+
+    def test_rolled_up_fractions_not_cached(self):
+        # 0.3 + 0.6 + 0.1 rounds differently when 0.3 + 0.1 is summed first
+        table = biom.Table(np.array([[0.3], [0.6], [0.1]]),
+                           ['feat1', 'feat2', 'feat3'], ['A'])
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV: ''}):
+            expected = {level: _collapse_table(table, self.taxonomy, level)
+                        for level in (1, 2, 3)}
+            rolled_up = _collapse_levels(table, self.taxonomy, [1, 2, 3])
+        self.assertNotEqual(rolled_up[1], expected[1])
+
+        actual = _collapse_levels(table, self.taxonomy, [1, 2, 3])
+        self.assertEqual(actual, rolled_up)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (0, 1))
+        for level in (1, 2, 3):
+            self.assertEqual(_collapse_table(table, self.taxonomy, level),
+                             expected[level])
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (1, 3))
+        self.assertEqual(_collapse_levels(table, self.taxonomy, [1, 2, 3]),
+                         rolled_up)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses), (2, 3))
+
+    def test_hits_equal_collapsing(self):
+        rng = np.random.default_rng(0)
+        n_features, n_samples = 20000, 200
+        matrix = scipy.sparse.random(n_features, n_samples, density=0.05,
+                                     format='csr', random_state=0)
+        matrix.data = np.ceil(matrix.data * 100)
+        feature_ids = ['feat%d' % i for i in range(n_features)]
+        table = biom.Table(matrix, feature_ids,
+                           ['S%d' % i for i in range(n_samples)])
+        taxonomy = TaxonomyIndex.from_series(pd.Series(
+            ['k__%d; p__%d; c__%d; o__%d; f__%d; g__%d; s__%d'
+             % (i % 3, i % 30, i % 100, i % 300, i % 1000, i % 3000, i)
+             for i in rng.integers(0, 10000, n_features)],
+            index=feature_ids))
+        levels = range(1, 8)
+
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV: ''}):
+            expected = _collapse_levels(table, taxonomy, levels)
+        self.assertEqual(_collapse_levels(table, taxonomy, levels), expected)
+        self.assertEqual((collapse_cache.hits, collapse_cache.misses),
+                         (0, len(levels)))
+
+        for _ in range(3):
+            actual = _collapse_levels(table, taxonomy, levels)
+            self.assertEqual(actual, expected)
+        self.assertEqual(collapse_cache.memory_hits, 3 * len(levels))
+        self.assertEqual(collapse_cache.misses, len(levels))
+
+
+if __name__ == '__main__':
+    unittest.main()
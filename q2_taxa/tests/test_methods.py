@@ -6,16 +6,28 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import tempfile
 import unittest
+from unittest import mock
 
+import h5py
 import numpy as np
 import biom
 import pandas as pd
 import pandas.testing as pdt
 import qiime2
 from qiime2.plugin.testing import TestPluginBase
+from q2_types.feature_data import DNAFASTAFormat
+from q2_types.feature_table import BIOMV210Format
 
-from q2_taxa import collapse, filter_table, filter_seqs
+from q2_taxa import (collapse, collapse_batch, collapse_incremental,
+                     collapse_levels, collapse_merge, collapse_plan,
+                     collapse_presence_absence, collapse_streaming,
+                     collapse_with_plan, filter_table, filter_seqs)
+from q2_taxa._cache import CACHE_DIR_ENV
+from q2_taxa._search import LineageSearchIndex
+from q2_taxa._taxonomy import TaxonomyIndex
 
 
 class CollapseTests(unittest.TestCase):
@@ -99,6 +111,149 @@ class CollapseTests(unittest.TestCase):
                               ['a;b;__', 'a;b;d']).transpose()
         self.assertEqual(actual, expected)
 
+    def test_collapse_shared_lineages(self):
+        table = biom.Table(np.array([[2.0, 2.0, 1.0, 0.0],
+                                     [1.0, 1.0, 3.0, 5.0],
+                                     [9.0, 8.0, 0.0, 1.0]]),
+                           ['A', 'B', 'C'],
+                           ['feat1', 'feat2', 'feat3', 'feat4']).transpose()
+        taxonomy = pd.Series(['a; b; d', 'a; b; c', 'a; b; d', 'a;b;c'],
+                             index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+        actual = collapse(table, taxonomy, 3)
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat3']},
+                          {'collapsed_ids': ['feat2', 'feat4']}))
+        actual.del_metadata()
+        expected = biom.Table(np.array([[3.0, 2.0], [4.0, 6.0], [9.0, 9.0]]),
+                              ['A', 'B', 'C'],
+                              ['a;b;d', 'a;b;c']).transpose()
+        self.assertEqual(actual, expected)
+
+    def test_collapse_max_level_source(self):
+        table = biom.Table(np.array([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0],
+                                     [0.0, 4.0]]),
+                           ['A', 'B', 'C', 'D'],
+                           ['feat1', 'feat2']).transpose()
+        taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; b; c; e'],
+                             index=['feat1', 'feat2', 'feat3'])
+
+        actual = collapse(table, taxonomy, 4)
+        actual.del_metadata()
+        expected = biom.Table(np.array([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0],
+                                        [0.0, 4.0]]),
+                              ['A', 'B', 'C', 'D'],
+                              ['a;b;c;__', 'a;b;d;__']).transpose()
+        self.assertEqual(actual, expected)
+
+        actual = collapse(table, taxonomy, 3, max_level_source='table')
+        actual.del_metadata()
+        expected = biom.Table(np.array([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0],
+                                        [0.0, 4.0]]),
+                              ['A', 'B', 'C', 'D'],
+                              ['a;b;c', 'a;b;d']).transpose()
+        self.assertEqual(actual, expected)
+
+        with self.assertRaisesRegex(ValueError, r'of 4 is larger.*\(3\)'):
+            collapse(table, taxonomy, 4, max_level_source='table')
+
+        with self.assertRaisesRegex(ValueError, 'Unknown max_level_source'):
+            collapse(table, taxonomy, 1, max_level_source='foo')
+
+    def test_collapse_n_jobs(self):
+        data = np.random.RandomState(0).poisson(
+            0.5, size=(12, 7)).astype(float)
+        table = biom.Table(data, ['feat%d' % i for i in range(12)],
+                           ['S%d' % i for i in range(7)])
+        taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g; h'] * 3,
+                             index=['feat%d' % i for i in range(12)])
+
+        for level in (1, 2, 3):
+            expected = collapse(table, taxonomy, level)
+            for n_jobs in (2, 3, 7, 20):
+                actual = collapse(table, taxonomy, level, n_jobs=n_jobs)
+                self.assertEqual(actual, expected)
+
+        with self.assertRaisesRegex(ValueError, r'jobs \(0\) is too low'):
+            collapse(table, taxonomy, 1, n_jobs=0)
+
+    def test_collapse_min_frequency_min_samples(self):
+        table = biom.Table(np.array([[2.0, 0.0, 0.0, 1.0],
+                                     [1.0, 0.0, 0.0, 0.0],
+                                     [9.0, 0.0, 3.0, 0.0],
+                                     [0.0, 0.0, 4.0, 0.0]]),
+                           ['A', 'B', 'C', 'D'],
+                           ['feat1', 'feat2', 'feat3', 'feat4']).transpose()
+        taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                             index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+        actual = collapse(table, taxonomy, 2, min_frequency=7)
+        self.assertEqual(list(actual.ids(axis='observation')), ['a;b', 'a;e'])
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat2']},
+                          {'collapsed_ids': ['feat3']}))
+
+        actual = collapse(table, taxonomy, 2, min_samples=2)
+        self.assertEqual(list(actual.ids(axis='observation')), ['a;b', 'a;e'])
+
+        actual = collapse(table, taxonomy, 3, min_frequency=2, min_samples=2)
+        expected = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                        [0.0, 0.0, 3.0, 4.0]]),
+                              ['a;b;c', 'a;e;__'], ['A', 'B', 'C', 'D'])
+        actual.del_metadata()
+        self.assertEqual(actual, expected)
+
+        for level in (1, 2, 3):
+            unfiltered = collapse(table, taxonomy, level)
+            for min_frequency, min_samples in ((0, 0), (3, 0), (0, 2),
+                                               (4, 2), (100, 0)):
+                df = unfiltered.to_dataframe(dense=True)
+                keep = ((df.sum(axis=1) >= min_frequency) &
+                        ((df > 0).sum(axis=1) >= min_samples))
+                expected = unfiltered.filter(
+                    df.index[keep], axis='observation', inplace=False)
+                actual = collapse(table, taxonomy, level,
+                                  min_frequency=min_frequency,
+                                  min_samples=min_samples)
+                if keep.any():
+                    self.assertEqual(actual.metadata(axis='observation'),
+                                     expected.metadata(axis='observation'))
+                pdt.assert_frame_equal(actual.to_dataframe(dense=True),
+                                       expected.to_dataframe(dense=True))
+
+        with self.assertRaisesRegex(ValueError, 'greater than or equal to 0'):
+            collapse(table, taxonomy, 1, min_frequency=-1)
+
+    def test_collapse_relative(self):
+        table = biom.Table(np.array([[2.0, 0.0, 0.0, 1.0],
+                                     [1.0, 0.0, 0.0, 0.0],
+                                     [9.0, 0.0, 3.0, 0.0],
+                                     [0.0, 0.0, 0.0, 0.0]]),
+                           ['A', 'B', 'C', 'D'],
+                           ['feat1', 'feat2', 'feat3', 'feat4']).transpose()
+        taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                             index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+        actual = collapse(table, taxonomy, 2, relative=True)
+        expected = pd.DataFrame([[2 / 3, 1.0, 0.75, 0.0],
+                                 [0.0, 0.0, 0.25, 0.0],
+                                 [1 / 3, 0.0, 0.0, 0.0]],
+                                index=['a;b', 'a;e', 'f;g'],
+                                columns=['A', 'B', 'C', 'D'])
+        pdt.assert_frame_equal(actual.to_dataframe(dense=True), expected)
+        self.assertEqual(actual.metadata(axis='observation'),
+                         collapse(table, taxonomy, 2).metadata(
+                             axis='observation'))
+
+        for level in (1, 2, 3):
+            expected = collapse(table, taxonomy, level, min_frequency=2)
+            expected = expected.norm(axis='sample', inplace=False)
+            actual = collapse(table, taxonomy, level, min_frequency=2,
+                              relative=True)
+            pdt.assert_frame_equal(actual.to_dataframe(dense=True),
+                                   expected.to_dataframe(dense=True).fillna(
+                                       0.0))
+
     def test_collapse_bad_level(self):
         table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
                              index=['A', 'B', 'C', 'D'],
@@ -124,12 +279,335 @@ class CollapseTests(unittest.TestCase):
             collapse(table, taxonomy, 1)
 
 
+class CollapsePlanTests(unittest.TestCase):
+
+    def setUp(self):
+        self.table = biom.Table(np.array([[2.0, 2.0, 0.0, 3.0],
+                                          [1.0, 1.0, 3.0, 0.0],
+                                          [9.0, 8.0, 1.0, 1.0]]),
+                                ['A', 'B', 'C'],
+                                ['feat1', 'feat2', 'feat3', 'feat4']
+                                ).transpose()
+        self.taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                                  index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+    def test_collapse_plan(self):
+        actual = collapse_plan(self.table, self.taxonomy, 2)
+        expected = pd.Series(['a;b', 'a;b', 'a;e', 'f;g'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3',
+                                             'feat4'], name='Feature ID'),
+                             name='Taxon')
+        pdt.assert_series_equal(actual, expected)
+
+        actual = collapse_plan(self.table, self.taxonomy, 3)
+        self.assertEqual(list(actual), ['a;b;c', 'a;b;d', 'a;e;__', 'f;g;__'])
+
+    def test_collapse_with_plan(self):
+        for level in (1, 2, 3):
+            plan = collapse_plan(self.table, self.taxonomy, level)
+            self.assertEqual(collapse_with_plan(self.table, plan),
+                             collapse(self.table, self.taxonomy, level))
+
+            subset = self.table.filter(['feat4', 'feat2'],
+                                       axis='observation', inplace=False)
+            subset = subset.filter(['A', 'C'], inplace=False)
+            self.assertEqual(collapse_with_plan(subset, plan),
+                             collapse(subset, self.taxonomy, level))
+
+    def test_collapse_with_plan_missing_table_ids_in_plan(self):
+        plan = collapse_plan(self.table, self.taxonomy, 2)
+        with self.assertRaisesRegex(ValueError, 'missing.*feat4'):
+            collapse_with_plan(self.table, plan[:3])
+
+    def test_collapse_plan_bad_level(self):
+        with self.assertRaisesRegex(ValueError, 'of 4 is larger'):
+            collapse_plan(self.table, self.taxonomy, 4)
+
+
+class CollapseLevelsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.table = biom.Table(np.array([[2.0, 2.0, 0.0, 3.0],
+                                          [1.0, 1.0, 3.0, 0.0],
+                                          [9.0, 8.0, 1.0, 1.0]]),
+                                ['A', 'B', 'C'],
+                                ['feat1', 'feat2', 'feat3', 'feat4']
+                                ).transpose()
+        self.taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                                  index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+    def test_collapse_levels(self):
+        for n_jobs in (1, 2):
+            actual = collapse_levels(self.table, self.taxonomy, [3, 1, 2],
+                                     n_jobs=n_jobs)
+
+            self.assertEqual(list(actual), ['level-3', 'level-1', 'level-2'])
+            for level in (1, 2, 3):
+                self.assertEqual(actual['level-%d' % level],
+                                 collapse(self.table, self.taxonomy, level))
+
+    def test_collapse_levels_bad_level(self):
+        with self.assertRaisesRegex(ValueError, 'of 4 is larger'):
+            collapse_levels(self.table, self.taxonomy, [1, 4])
+
+        with self.assertRaisesRegex(ValueError, 'of 0 is too low'):
+            collapse_levels(self.table, self.taxonomy, [0, 1])
+
+        with self.assertRaisesRegex(ValueError, 'At least one level'):
+            collapse_levels(self.table, self.taxonomy, [])
+
+    def test_collapse_levels_missing_table_ids_in_taxonomy(self):
+        with self.assertRaisesRegex(ValueError, 'missing.*feat4'):
+            collapse_levels(self.table, self.taxonomy[:3], [1, 2])
+
+
+class CollapseBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                                  index=['feat1', 'feat2', 'feat3', 'feat4'])
+        self.tables = {
+            'run1': biom.Table(np.array([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0]]),
+                               ['feat1', 'feat2', 'feat3'], ['A', 'B']),
+            'run2': biom.Table(np.array([[0.0, 3.0], [4.0, 0.0], [1.0, 1.0]]),
+                               ['feat4', 'feat1', 'feat3'], ['C', 'D'])}
+
+    def test_collapse_batch(self):
+        for n_jobs in (1, 2):
+            actual = collapse_batch(self.tables, self.taxonomy, [1, 3],
+                                    n_jobs=n_jobs)
+
+            self.assertEqual(set(actual), {'run1-level-1', 'run1-level-3',
+                                           'run2-level-1', 'run2-level-3'})
+            for name, table in self.tables.items():
+                for level in (1, 3):
+                    self.assertEqual(actual['%s-level-%d' % (name, level)],
+                                     collapse(table, self.taxonomy, level))
+
+    def test_collapse_batch_bad_level(self):
+        with self.assertRaisesRegex(ValueError, 'of 4 is larger'):
+            collapse_batch(self.tables, self.taxonomy, [1, 4])
+
+        with self.assertRaisesRegex(ValueError, 'of 0 is too low'):
+            collapse_batch(self.tables, self.taxonomy, [0, 1])
+
+        with self.assertRaisesRegex(ValueError, 'At least one level'):
+            collapse_batch(self.tables, self.taxonomy, [])
+
+    def test_collapse_batch_missing_table_ids_in_taxonomy(self):
+        with self.assertRaisesRegex(ValueError, 'missing.*feat4'):
+            collapse_batch(self.tables, self.taxonomy[:3], [1])
+
+
+class CollapseStreamingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.table = biom.Table(np.array([[2.0, 2.0, 0.0],
+                                          [1.0, 1.0, 3.0],
+                                          [9.0, 8.0, 1.0],
+                                          [0.0, 4.0, 0.0],
+                                          [5.0, 0.0, 7.0]]),
+                                ['A', 'B', 'C', 'D', 'E'],
+                                ['feat1', 'feat2', 'feat3']).transpose()
+        self.taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e'],
+                                  index=['feat1', 'feat2', 'feat3'])
+        self.table_fmt = BIOMV210Format()
+        with h5py.File(str(self.table_fmt), 'w') as fh:
+            self.table.to_hdf5(fh, 'q2-taxa')
+
+    def test_collapse_streaming(self):
+        for level in (1, 2, 3):
+            expected = collapse(self.table, self.taxonomy, level)
+            for block_size in (1, 2, 5, 100):
+                actual = collapse_streaming(self.table_fmt, self.taxonomy,
+                                            level, block_size=block_size)
+                self.assertEqual(actual.metadata(axis='observation'),
+                                 expected.metadata(axis='observation'))
+                pdt.assert_frame_equal(actual.to_dataframe(dense=True),
+                                       expected.to_dataframe(dense=True))
+
+    def test_collapse_streaming_missing_table_ids_in_taxonomy(self):
+        taxonomy = pd.Series(['a; b; c', 'a; b; d'],
+                             index=['feat1', 'feat2'])
+        with self.assertRaisesRegex(ValueError, 'missing.*feat3'):
+            collapse_streaming(self.table_fmt, taxonomy, 1)
+
+    def test_collapse_streaming_bad_block_size(self):
+        with self.assertRaisesRegex(ValueError, 'block size of 0 is too low'):
+            collapse_streaming(self.table_fmt, self.taxonomy, 1,
+                               block_size=0)
+
+
+class CollapseMergeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                                  index=['feat1', 'feat2', 'feat3', 'feat4'])
+        self.table1 = biom.Table(np.array([[2.0, 2.0], [1.0, 1.0],
+                                           [9.0, 8.0]]),
+                                 ['feat1', 'feat2', 'feat3'], ['A', 'B'])
+        self.table2 = biom.Table(np.array([[0.0, 3.0, 1.0], [4.0, 0.0, 2.0],
+                                           [1.0, 1.0, 0.0]]),
+                                 ['feat4', 'feat1', 'feat3'], ['C', 'D', 'E'])
+
+    def _to_format(self, table):
+        table_fmt = BIOMV210Format()
+        with h5py.File(str(table_fmt), 'w') as fh:
+            table.to_hdf5(fh, 'q2-taxa')
+        return table_fmt
+
+    def test_collapse_merge(self):
+        tables = [self._to_format(self.table1), self._to_format(self.table2)]
+        merged = self.table1.merge(self.table2)
+        for level in (1, 2, 3):
+            expected = collapse(merged, self.taxonomy, level)
+            for block_size in (1, 2, 100):
+                actual = collapse_merge(tables, self.taxonomy, level,
+                                        block_size=block_size)
+                pdt.assert_frame_equal(
+                    actual.to_dataframe(dense=True).sort_index(),
+                    expected.to_dataframe(dense=True).sort_index(),
+                    check_like=True)
+
+    def test_collapse_merge_collapsed_ids(self):
+        tables = [self._to_format(self.table1), self._to_format(self.table2)]
+        actual = collapse_merge(tables, self.taxonomy, 1)
+
+        self.assertEqual(list(actual.ids(axis='observation')),
+                         ['a', 'f'])
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat2', 'feat3']},
+                          {'collapsed_ids': ['feat4']}))
+        self.assertEqual(list(actual.ids()), ['A', 'B', 'C', 'D', 'E'])
+
+    def test_collapse_merge_overlapping_samples(self):
+        table3 = biom.Table(np.array([[5.0], [1.0]]), ['feat2', 'feat4'],
+                            ['A'])
+        tables = [self._to_format(self.table1), self._to_format(table3)]
+
+        with self.assertRaisesRegex(ValueError, 'more than one table.*A'):
+            collapse_merge(tables, self.taxonomy, 2)
+
+        actual = collapse_merge(tables, self.taxonomy, 2,
+                                overlap_method='sum')
+        expected = pd.DataFrame([[8.0, 3.0], [9.0, 8.0], [1.0, 0.0]],
+                                index=['a;b', 'a;e', 'f;g'],
+                                columns=['A', 'B'])
+        pdt.assert_frame_equal(actual.to_dataframe(dense=True), expected)
+
+    def test_collapse_merge_missing_table_ids_in_taxonomy(self):
+        tables = [self._to_format(self.table1), self._to_format(self.table2)]
+        with self.assertRaisesRegex(ValueError, 'missing.*feat4'):
+            collapse_merge(tables, self.taxonomy[:3], 1)
+
+    def test_collapse_merge_bad_level(self):
+        tables = [self._to_format(self.table1)]
+        with self.assertRaisesRegex(ValueError, 'of 4 is larger'):
+            collapse_merge(tables, self.taxonomy, 4)
+
+        with self.assertRaisesRegex(ValueError, 'block size of 0 is too low'):
+            collapse_merge(tables, self.taxonomy, 1, block_size=0)
+
+
+class CollapseIncrementalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'],
+                                  index=['feat1', 'feat2', 'feat3', 'feat4'])
+        self.old = biom.Table(np.array([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0]]),
+                              ['feat1', 'feat2', 'feat3'], ['A', 'B'])
+        self.new = biom.Table(np.array([[0.0, 3.0], [4.0, 0.0], [1.0, 1.0]]),
+                              ['feat4', 'feat1', 'feat3'], ['C', 'D'])
+
+    def test_collapse_incremental(self):
+        collapsed = collapse(self.old, self.taxonomy, 2)
+
+        actual = collapse_incremental(collapsed, self.new, self.taxonomy, 2)
+
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat2']},
+                          {'collapsed_ids': ['feat3']},
+                          {'collapsed_ids': ['feat4']}))
+        actual.del_metadata()
+        expected = biom.Table(np.array([[3.0, 3.0, 4.0, 0.0],
+                                        [9.0, 8.0, 1.0, 1.0],
+                                        [0.0, 0.0, 0.0, 3.0]]),
+                              ['a;b', 'a;e', 'f;g'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(actual, expected)
+
+    def test_collapse_incremental_matches_collapse(self):
+        collapsed = collapse(self.old, self.taxonomy, 1)
+        actual = collapse_incremental(collapsed, self.new, self.taxonomy, 1)
+
+        merged = self.old.merge(self.new)
+        expected = collapse(merged, self.taxonomy, 1)
+        self.assertEqual(actual.sort(axis='observation'),
+                         expected.sort(axis='observation'))
+
+    def test_collapse_incremental_overlapping_samples(self):
+        collapsed = collapse(self.old, self.taxonomy, 2)
+        new = self.new.update_ids({'C': 'A', 'D': 'D'}, inplace=False)
+
+        with self.assertRaisesRegex(ValueError, 'already present.*A'):
+            collapse_incremental(collapsed, new, self.taxonomy, 2)
+
+    def test_collapse_incremental_wrong_level(self):
+        collapsed = collapse(self.old, self.taxonomy, 2)
+
+        with self.assertRaisesRegex(ValueError, 'not.*collapsed at level 3'):
+            collapse_incremental(collapsed, self.new, self.taxonomy, 3)
+
+
+class CollapsePresenceAbsenceTests(unittest.TestCase):
+
+    def test_collapse_presence_absence(self):
+        table = biom.Table(np.array([[1.0, 0.0, 0.0],
+                                     [1.0, 1.0, 0.0],
+                                     [0.0, 0.0, 0.0],
+                                     [0.0, 1.0, 1.0]]),
+                           ['feat1', 'feat2', 'feat3', 'feat4'],
+                           ['A', 'B', 'C'])
+        taxonomy = pd.Series(['a; b', 'c; d', 'a; e', 'a; b'],
+                             index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+        actual = collapse_presence_absence(table, taxonomy, 1)
+        self.assertEqual(actual.metadata(axis='observation'),
+                         ({'collapsed_ids': ['feat1', 'feat3', 'feat4']},
+                          {'collapsed_ids': ['feat2']}))
+        actual.del_metadata()
+        expected = biom.Table(np.array([[1.0, 1.0, 1.0], [1.0, 1.0, 0.0]]),
+                              ['a', 'c'], ['A', 'B', 'C'])
+        self.assertEqual(actual, expected)
+
+        actual = collapse_presence_absence(table, taxonomy, 2)
+        actual.del_metadata()
+        expected = biom.Table(np.array([[1.0, 1.0, 1.0],
+                                        [1.0, 1.0, 0.0],
+                                        [0.0, 0.0, 0.0]]),
+                              ['a;b', 'c;d', 'a;e'], ['A', 'B', 'C'])
+        self.assertEqual(actual, expected)
+
+    def test_collapse_presence_absence_matches_collapse(self):
+        data = np.random.RandomState(0).binomial(1, 0.1, size=(40, 21))
+        table = biom.Table(data.astype(float),
+                           ['feat%d' % i for i in range(40)],
+                           ['S%d' % i for i in range(21)])
+        taxonomy = pd.Series(['a; b; c', 'a; b; d', 'a; e', 'f; g'] * 10,
+                             index=['feat%d' % i for i in range(40)])
+
+        for level in (1, 2, 3):
+            expected = collapse(table, taxonomy, level)
+            expected = expected.pa(inplace=False)
+            actual = collapse_presence_absence(table, taxonomy, level)
+            self.assertEqual(actual, expected)
+
+
 class FilterTable(unittest.TestCase):
 
     def test_filter_no_filters(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -139,9 +617,9 @@ class FilterTable(unittest.TestCase):
             filter_table(table, taxonomy)
 
     def test_alt_delimiter(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -150,20 +628,55 @@ class FilterTable(unittest.TestCase):
         # include with delimiter
         obs = filter_table(table, taxonomy, include='cc@peanut@ee',
                            query_delimiter='@peanut@')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         # exclude with delimiter
         obs = filter_table(table, taxonomy, exclude='ww@peanut@ee',
                            query_delimiter='@peanut@')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
+
+    def test_input_table_unchanged(self):
+        table = biom.Table(np.array([[2.0, 1.0, 0.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'],
+                           [{'x': 1}, {'x': 2}],
+                           [{'y': 'a'}, {'y': 'b'}, {'y': 'c'}, {'y': 'd'}])
+        expected_input = table.copy()
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
+                             index=pd.Index(['feat1', 'feat2'], name='id'),
+                             columns=['Taxon']))
+
+        obs = filter_table(table, taxonomy, include='cc')
+        exp = biom.Table(np.array([[2.0, 1.0]]), ['feat1'], ['A', 'B'],
+                         [{'x': 1}], [{'y': 'a'}, {'y': 'b'}])
+        self.assertEqual(obs, exp)
+        self.assertIsNot(obs, table)
+        self.assertEqual(table, expected_input)
+
+    def test_parses_only_table_lineages(self):
+        ids = ['feat%d' % i for i in range(100)]
+        lineages = ['aa; bb%d; cc%d' % (i % 2, i) for i in range(100)]
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(lineages, index=pd.Index(ids, name='id'),
+                             columns=['Taxon']))
+        table = biom.Table(np.array([[2.0], [1.0], [3.0]]),
+                           ['feat7', 'feat2', 'feat4'], ['A'])
+
+        with mock.patch.object(TaxonomyIndex, 'from_series',
+                               wraps=TaxonomyIndex.from_series) as parse:
+            obs = filter_table(table, taxonomy, include='bb1')
+        parse.assert_called_once()
+        self.assertEqual(list(parse.call_args.args[0].index),
+                         ['feat7', 'feat2', 'feat4'])
+        self.assertEqual(obs, biom.Table(np.array([[2.0]]), ['feat7'], ['A']))
 
     def test_filter_table_unknown_mode(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -173,9 +686,9 @@ class FilterTable(unittest.TestCase):
             filter_table(table, taxonomy, include='bb', mode='not-a-mode')
 
     def test_filter_table_include(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -183,57 +696,51 @@ class FilterTable(unittest.TestCase):
 
         # keep both features
         obs = filter_table(table, taxonomy, include='bb')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         obs = filter_table(table, taxonomy, include='cc,ee')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         # keep feat1 only
         obs = filter_table(table, taxonomy, include='cc')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, include='aa; bb; cc')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat2 only
         obs = filter_table(table, taxonomy, include='dd')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, include='ee')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, include='dd ee')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, include='aa; bb; dd ee')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         # keep no features
         with self.assertRaisesRegex(ValueError, expected_regex='empty table'):
             obs = filter_table(table, taxonomy, include='peanut!')
 
     def test_filter_table_include_exact_match(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -242,32 +749,30 @@ class FilterTable(unittest.TestCase):
         # keep both features
         obs = filter_table(table, taxonomy, include='aa; bb; cc,aa; bb; dd ee',
                            mode='exact')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         # keep feat1 only
         obs = filter_table(table, taxonomy, include='aa; bb; cc',
                            mode='exact')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat2 only
         obs = filter_table(table, taxonomy, include='aa; bb; dd ee',
                            mode='exact')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         # keep no features
         with self.assertRaisesRegex(ValueError, expected_regex='empty table'):
             obs = filter_table(table, taxonomy, include='bb', mode='exact')
 
     def test_filter_table_exclude(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -275,42 +780,37 @@ class FilterTable(unittest.TestCase):
 
         # keep both features
         obs = filter_table(table, taxonomy, exclude='ab')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         obs = filter_table(table, taxonomy, exclude='xx')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         # keep feat1 only
         obs = filter_table(table, taxonomy, exclude='dd')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, exclude='dd ee')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, exclude='aa; bb; dd ee')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat2 only
         obs = filter_table(table, taxonomy, exclude='cc')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, exclude='aa; bb; cc')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         # keep no features
         with self.assertRaisesRegex(ValueError, expected_regex='empty table'):
@@ -320,9 +820,9 @@ class FilterTable(unittest.TestCase):
             obs = filter_table(table, taxonomy, exclude='aa; bb')
 
     def test_filter_table_exclude_exact_match(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -331,37 +831,33 @@ class FilterTable(unittest.TestCase):
         # keep both features
         obs = filter_table(table, taxonomy, exclude='peanut!',
                            mode='exact')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         # keep feat1 only
         obs = filter_table(table, taxonomy, exclude='aa; bb; dd ee',
                            mode='exact')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, exclude='aa; bb; dd ee,aa',
                            mode='exact')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat2 only
         obs = filter_table(table, taxonomy, exclude='aa; bb; cc',
                            mode='exact')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         obs = filter_table(table, taxonomy, exclude='aa; bb; cc,aa',
                            mode='exact')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         # keep no features
         with self.assertRaisesRegex(ValueError, expected_regex='empty table'):
@@ -370,9 +866,9 @@ class FilterTable(unittest.TestCase):
                                mode='exact')
 
     def test_filter_table_include_exclude(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -380,35 +876,31 @@ class FilterTable(unittest.TestCase):
 
         # keep both features
         obs = filter_table(table, taxonomy, include='aa', exclude='peanut!')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
         # keep feat1 only - feat2 dropped at exclusion step
         obs = filter_table(table, taxonomy, include='aa', exclude='ee')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat1 only - feat2 dropped at inclusion step
         obs = filter_table(table, taxonomy, include='cc', exclude='ee')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat2 only - feat1 dropped at exclusion step
         obs = filter_table(table, taxonomy, include='aa', exclude='cc')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         # keep feat2 only - feat1 dropped at inclusion step
         obs = filter_table(table, taxonomy, include='ee', exclude='cc')
-        exp = pd.DataFrame([[2.0], [1.0], [8.0], [4.0]],
-                           index=['A', 'B', 'C', 'D'],
-                           columns=['feat2'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0]]),
+                         ['feat2'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
 
         # keep no features - all dropped at exclusion
         with self.assertRaisesRegex(ValueError, expected_regex='empty table'):
@@ -431,10 +923,131 @@ class FilterTable(unittest.TestCase):
                                exclude='bb',
                                mode='exact')
 
+    def test_filter_table_rank(self):
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0],
+                                     [1.0, 0.0, 0.0, 0.0]]),
+                           ['feat1', 'feat2', 'feat3'], ['A', 'B', 'C', 'D'])
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['p__Bacteroidetes; g__Bacteroides',
+                              'p__Firmicutes; g__Bacteroidales',
+                              'p__Firmicutes'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3'],
+                                            name='id'),
+                             columns=['Taxon']))
+
+        # unlike contains, rank terms only match whole ranks
+        obs = filter_table(table, taxonomy, include='g__:Bacteroides',
+                           mode='rank')
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]), ['feat1'],
+                         ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
+
+        obs = filter_table(table, taxonomy,
+                           include='g__:Bacteroides,p__:Firmicutes',
+                           mode='rank')
+        self.assertEqual(obs, table)
+
+        obs = filter_table(table, taxonomy, exclude='p__ : Firmicutes',
+                           mode='rank')
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]), ['feat1'],
+                         ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
+
+        # levels can be given by number
+        obs = filter_table(table, taxonomy, include='1:p__Firmicutes',
+                           exclude='2:g__Bacteroidales', mode='rank')
+        exp = biom.Table(np.array([[1.0]]), ['feat3'], ['A'])
+        self.assertEqual(obs, exp)
+
+        with self.assertRaisesRegex(ValueError, 'empty table'):
+            filter_table(table, taxonomy, include='2:p__Firmicutes',
+                         mode='rank')
+
+        with self.assertRaisesRegex(ValueError, '<rank>:<name>.*Firmicutes'):
+            filter_table(table, taxonomy, include='Firmicutes', mode='rank')
+
+    def test_filter_table_regex(self):
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0],
+                                     [1.0, 0.0, 0.0, 0.0]]),
+                           ['feat1', 'feat2', 'feat3'], ['A', 'B', 'C', 'D'])
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['p__Bacteroidetes; g__Bacteroides',
+                              'p__Firmicutes; g__Bacteroidales',
+                              'p__Firmicutes'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3'],
+                                            name='id'),
+                             columns=['Taxon']))
+
+        obs = filter_table(table, taxonomy, include=r'g__Bacteroides$',
+                           mode='regex')
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]), ['feat1'],
+                         ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
+
+        obs = filter_table(table, taxonomy, include='^p__Firm,ides$',
+                           exclude='g__[A-Z]', mode='regex')
+        exp = biom.Table(np.array([[1.0]]), ['feat3'], ['A'])
+        self.assertEqual(obs, exp)
+
+        # matching is case-sensitive
+        with self.assertRaisesRegex(ValueError, 'empty table'):
+            filter_table(table, taxonomy, include='firmicutes', mode='regex')
+
+        # unless a term sets its own flags
+        obs = filter_table(table, taxonomy, include='(?i)FIRMICUTES$',
+                           mode='regex')
+        exp = biom.Table(np.array([[1.0]]), ['feat3'], ['A'])
+        self.assertEqual(obs, exp)
+
+        with self.assertRaisesRegex(ValueError, 'Invalid regular expression'):
+            filter_table(table, taxonomy, include='g__(', mode='regex')
+
+    def test_filter_table_query(self):
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0],
+                                     [1.0, 0.0, 0.0, 0.0],
+                                     [1.0, 0.0, 0.0, 3.0]]),
+                           ['feat1', 'feat2', 'feat3', 'feat4'],
+                           ['A', 'B', 'C', 'D'])
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['k__Bacteria; p__Bacteroidetes',
+                              'k__Bacteria; p__Cyanobacteria; c__Chloroplast',
+                              'k__Archaea; p__Euryarchaeota',
+                              'k__Eukaryota'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3',
+                                             'feat4'], name='id'),
+                             columns=['Taxon']))
+
+        obs = filter_table(table, taxonomy,
+                           query='(Bacteria AND NOT Chloroplast) OR Archaea')
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0], [1.0, 0.0, 0.0]]),
+                         ['feat1', 'feat3'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
+
+        # modes can be set per term
+        obs = filter_table(table, taxonomy,
+                           query='exact:k__Eukaryota OR '
+                                 'rank:p__:Cyanobacteria', mode='regex')
+        exp = biom.Table(np.array([[2.0, 1.0, 8.0, 4.0],
+                                   [1.0, 0.0, 0.0, 3.0]]),
+                         ['feat2', 'feat4'], ['A', 'B', 'C', 'D'])
+        self.assertEqual(obs, exp)
+
+        # queries are applied after include and exclude
+        obs = filter_table(table, taxonomy, include='Bacteria,Archaea',
+                           exclude='Bacteroidetes', query='NOT Chloroplast')
+        exp = biom.Table(np.array([[1.0]]), ['feat3'], ['A'])
+        self.assertEqual(obs, exp)
+
+        with self.assertRaisesRegex(ValueError, 'Invalid query'):
+            filter_table(table, taxonomy, query='Bacteria AND (Archaea')
+
     def test_filter_table_underscores_escaped(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -442,10 +1055,9 @@ class FilterTable(unittest.TestCase):
 
         # keep feat1 only - underscore not treated as a wild card
         obs = filter_table(table, taxonomy, include='cc,d_')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
         # keep feat1 only - underscore in query matches underscore in
         # taxonomy annotation
@@ -454,15 +1066,14 @@ class FilterTable(unittest.TestCase):
                              index=pd.Index(['feat1', 'feat2'], name='id'),
                              columns=['Taxon']))
         obs = filter_table(table, taxonomy, include='c_')
-        exp = pd.DataFrame([[2.0], [1.0], [9.0]],
-                           index=['A', 'B', 'C'],
-                           columns=['feat1'])
-        pdt.assert_frame_equal(obs, exp, check_like=True)
+        exp = biom.Table(np.array([[2.0, 1.0, 9.0]]),
+                         ['feat1'], ['A', 'B', 'C'])
+        self.assertEqual(obs, exp)
 
     def test_all_features_with_frequency_greater_than_zero_get_filtered(self):
-        table = pd.DataFrame([[2.0, 0.0], [1.0, 0.0], [9.0, 0.0], [1.0, 0.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 1.0],
+                                     [0.0, 0.0, 0.0, 0.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
@@ -475,9 +1086,9 @@ class FilterTable(unittest.TestCase):
             filter_table(table, taxonomy, include='dd')
 
     def test_extra_taxon_ignored(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee', 'aa; bb; cc'],
                              index=pd.Index(['feat1', 'feat2', 'feat3'],
@@ -486,12 +1097,12 @@ class FilterTable(unittest.TestCase):
 
         # keep both features
         obs = filter_table(table, taxonomy, include='bb')
-        pdt.assert_frame_equal(obs, table, check_like=True)
+        self.assertEqual(obs, table)
 
     def test_missing_taxon_errors(self):
-        table = pd.DataFrame([[2.0, 2.0], [1.0, 1.0], [9.0, 8.0], [0.0, 4.0]],
-                             index=['A', 'B', 'C', 'D'],
-                             columns=['feat1', 'feat2'])
+        table = biom.Table(np.array([[2.0, 1.0, 9.0, 0.0],
+                                     [2.0, 1.0, 8.0, 4.0]]),
+                           ['feat1', 'feat2'], ['A', 'B', 'C', 'D'])
         taxonomy = qiime2.Metadata(
                 pd.DataFrame(['aa; bb; cc'],
                              index=pd.Index(['feat1'], name='id'),
@@ -503,6 +1114,20 @@ class FilterTable(unittest.TestCase):
 
 class FilterSeqs(unittest.TestCase):
 
+    def filter_seqs(self, sequences, *args, **kwargs):
+        # filter_seqs streams FASTA files, so the sequences are written to and
+        # read back from DNAFASTAFormats around it
+        fmt = DNAFASTAFormat()
+        with open(str(fmt), 'w') as fh:
+            for id_, seq in sequences.items():
+                fh.write('>%s\n%s\n' % (id_, seq))
+
+        result = filter_seqs(fmt, *args, **kwargs)
+        with open(str(result)) as fh:
+            records = fh.read().split('>')[1:]
+        ids, seqs = zip(*(e.split() for e in records))
+        return pd.Series(seqs, index=ids)
+
     def test_filter_no_filters(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         taxonomy = qiime2.Metadata(
@@ -511,7 +1136,7 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         with self.assertRaisesRegex(ValueError, 'At least one'):
-            filter_seqs(seqs, taxonomy)
+            self.filter_seqs(seqs, taxonomy)
 
     def test_alt_delimiter(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -521,16 +1146,16 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # include with delimiter
-        obs = filter_seqs(seqs, taxonomy, include='cc@peanut@ee',
-                          query_delimiter='@peanut@')
+        obs = self.filter_seqs(seqs, taxonomy, include='cc@peanut@ee',
+                               query_delimiter='@peanut@')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # exclude with delimiter
-        obs = filter_seqs(seqs, taxonomy, exclude='ww@peanut@ee',
-                          query_delimiter='@peanut@')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='ww@peanut@ee',
+                               query_delimiter='@peanut@')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -544,7 +1169,7 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         with self.assertRaisesRegex(ValueError, 'Unknown mode'):
-            filter_seqs(seqs, taxonomy, include='bb', mode='not-a-mode')
+            self.filter_seqs(seqs, taxonomy, include='bb', mode='not-a-mode')
 
     def test_filter_seqs_include(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -554,51 +1179,51 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep both features
-        obs = filter_seqs(seqs, taxonomy, include='bb')
+        obs = self.filter_seqs(seqs, taxonomy, include='bb')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, include='cc,ee')
+        obs = self.filter_seqs(seqs, taxonomy, include='cc,ee')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat1 only
-        obs = filter_seqs(seqs, taxonomy, include='cc')
+        obs = self.filter_seqs(seqs, taxonomy, include='cc')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, include='aa; bb; cc')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa; bb; cc')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat2 only
-        obs = filter_seqs(seqs, taxonomy, include='dd')
+        obs = self.filter_seqs(seqs, taxonomy, include='dd')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, include='ee')
+        obs = self.filter_seqs(seqs, taxonomy, include='ee')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, include='dd ee')
+        obs = self.filter_seqs(seqs, taxonomy, include='dd ee')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, include='aa; bb; dd ee')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa; bb; dd ee')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -607,7 +1232,7 @@ class FilterSeqs(unittest.TestCase):
         # keep no features
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy, include='peanut!')
+            obs = self.filter_seqs(seqs, taxonomy, include='peanut!')
 
     def test_filter_seqs_include_exact_match(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -617,24 +1242,25 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep both features
-        obs = filter_seqs(seqs, taxonomy, include='aa; bb; cc,aa; bb; dd ee',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy,
+                               include='aa; bb; cc,aa; bb; dd ee',
+                               mode='exact')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat1 only
-        obs = filter_seqs(seqs, taxonomy, include='aa; bb; cc',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa; bb; cc',
+                               mode='exact')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat2 only
-        obs = filter_seqs(seqs, taxonomy, include='aa; bb; dd ee',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa; bb; dd ee',
+                               mode='exact')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -643,7 +1269,7 @@ class FilterSeqs(unittest.TestCase):
         # keep no features
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy, include='bb', mode='exact')
+            obs = self.filter_seqs(seqs, taxonomy, include='bb', mode='exact')
 
     def test_filter_seqs_exclude(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -653,45 +1279,45 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep both features
-        obs = filter_seqs(seqs, taxonomy, exclude='ab')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='ab')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, exclude='xx')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='xx')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat1 only
-        obs = filter_seqs(seqs, taxonomy, exclude='dd')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='dd')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, exclude='dd ee')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='dd ee')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, exclude='aa; bb; dd ee')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb; dd ee')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat2 only
-        obs = filter_seqs(seqs, taxonomy, exclude='cc')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='cc')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, exclude='aa; bb; cc')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb; cc')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -700,11 +1326,11 @@ class FilterSeqs(unittest.TestCase):
         # keep no features
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy, exclude='aa')
+            obs = self.filter_seqs(seqs, taxonomy, exclude='aa')
 
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy, exclude='aa; bb')
+            obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb')
 
     def test_filter_seqs_exclude_exact_match(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -714,38 +1340,38 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep both features
-        obs = filter_seqs(seqs, taxonomy, exclude='peanut!',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='peanut!',
+                               mode='exact')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat1 only
-        obs = filter_seqs(seqs, taxonomy, exclude='aa; bb; dd ee',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb; dd ee',
+                               mode='exact')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, exclude='aa; bb; dd ee,aa',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb; dd ee,aa',
+                               mode='exact')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat2 only
-        obs = filter_seqs(seqs, taxonomy, exclude='aa; bb; cc',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb; cc',
+                               mode='exact')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
-        obs = filter_seqs(seqs, taxonomy, exclude='aa; bb; cc,aa',
-                          mode='exact')
+        obs = self.filter_seqs(seqs, taxonomy, exclude='aa; bb; cc,aa',
+                               mode='exact')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -754,9 +1380,9 @@ class FilterSeqs(unittest.TestCase):
         # keep no features
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy,
-                              exclude='aa; bb; cc,aa; bb; dd ee',
-                              mode='exact')
+            obs = self.filter_seqs(seqs, taxonomy,
+                                   exclude='aa; bb; cc,aa; bb; dd ee',
+                                   mode='exact')
 
     def test_filter_seqs_include_exclude(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -766,35 +1392,35 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep both features
-        obs = filter_seqs(seqs, taxonomy, include='aa', exclude='peanut!')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa', exclude='peanut!')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat1 only - feat2 dropped at exclusion step
-        obs = filter_seqs(seqs, taxonomy, include='aa', exclude='ee')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa', exclude='ee')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat1 only - feat2 dropped at inclusion step
-        obs = filter_seqs(seqs, taxonomy, include='cc', exclude='ee')
+        obs = self.filter_seqs(seqs, taxonomy, include='cc', exclude='ee')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat2 only - feat1 dropped at exclusion step
-        obs = filter_seqs(seqs, taxonomy, include='aa', exclude='cc')
+        obs = self.filter_seqs(seqs, taxonomy, include='aa', exclude='cc')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
         pdt.assert_series_equal(obs, exp)
 
         # keep feat2 only - feat1 dropped at inclusion step
-        obs = filter_seqs(seqs, taxonomy, include='ee', exclude='cc')
+        obs = self.filter_seqs(seqs, taxonomy, include='ee', exclude='cc')
         exp = pd.Series(['ACCC'], index=['feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -803,26 +1429,81 @@ class FilterSeqs(unittest.TestCase):
         # keep no features - all dropped at exclusion
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy,
-                              include='aa',
-                              exclude='bb',
-                              mode='exact')
+            obs = self.filter_seqs(seqs, taxonomy,
+                                   include='aa',
+                                   exclude='bb',
+                                   mode='exact')
 
         # keep no features - one dropped at inclusion, one dropped at exclusion
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy,
-                              include='cc',
-                              exclude='cc',
-                              mode='exact')
+            obs = self.filter_seqs(seqs, taxonomy,
+                                   include='cc',
+                                   exclude='cc',
+                                   mode='exact')
 
         # keep no features - all dropped at inclusion
         with self.assertRaisesRegex(ValueError,
                                     expected_regex='empty collection'):
-            obs = filter_seqs(seqs, taxonomy,
-                              include='peanut',
-                              exclude='bb',
-                              mode='exact')
+            obs = self.filter_seqs(seqs, taxonomy,
+                                   include='peanut',
+                                   exclude='bb',
+                                   mode='exact')
+
+    def test_filter_seqs_rank(self):
+        seqs = pd.Series(['ACGT', 'ACCC', 'AAAA'],
+                         index=['feat1', 'feat2', 'feat3'])
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['p__Bacteroidetes; g__Bacteroides',
+                              'p__Firmicutes; g__Bacteroidales',
+                              'p__Firmicutes'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3'],
+                                            name='id'),
+                             columns=['Taxon']))
+
+        obs = self.filter_seqs(seqs, taxonomy, include='g__:Bacteroides',
+                               mode='rank')
+        pdt.assert_series_equal(obs, seqs[['feat1']])
+
+        obs = self.filter_seqs(seqs, taxonomy, include='p__:Firmicutes',
+                               exclude='2:g__Bacteroidales', mode='rank')
+        pdt.assert_series_equal(obs, seqs[['feat3']])
+
+    def test_filter_seqs_regex(self):
+        seqs = pd.Series(['ACGT', 'ACCC', 'AAAA'],
+                         index=['feat1', 'feat2', 'feat3'])
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['p__Bacteroidetes; g__Bacteroides',
+                              'p__Firmicutes; g__Bacteroidales',
+                              'p__Firmicutes'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3'],
+                                            name='id'),
+                             columns=['Taxon']))
+
+        obs = self.filter_seqs(seqs, taxonomy, include='Bacteroid(es|ales)$',
+                               mode='regex')
+        pdt.assert_series_equal(obs, seqs[['feat1', 'feat2']])
+
+        obs = self.filter_seqs(seqs, taxonomy, exclude='g__', mode='regex')
+        pdt.assert_series_equal(obs, seqs[['feat3']])
+
+    def test_filter_seqs_query(self):
+        seqs = pd.Series(['ACGT', 'ACCC', 'AAAA'],
+                         index=['feat1', 'feat2', 'feat3'])
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['k__Bacteria; p__Bacteroidetes',
+                              'k__Bacteria; p__Cyanobacteria; c__Chloroplast',
+                              'k__Archaea; p__Euryarchaeota'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3'],
+                                            name='id'),
+                             columns=['Taxon']))
+
+        obs = self.filter_seqs(
+            seqs, taxonomy, query='(Bacteria AND NOT Chloroplast) OR Archaea')
+        pdt.assert_series_equal(obs, seqs[['feat1', 'feat3']])
+
+        obs = self.filter_seqs(seqs, taxonomy, query='regex:"^k__B" AND c__')
+        pdt.assert_series_equal(obs, seqs[['feat2']])
 
     def test_filter_seqs_underscores_escaped(self):
         seqs = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
@@ -832,7 +1513,7 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep feat1 only - underscore not treated as a wild card
-        obs = filter_seqs(seqs, taxonomy, include='cc,d_')
+        obs = self.filter_seqs(seqs, taxonomy, include='cc,d_')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -844,7 +1525,7 @@ class FilterSeqs(unittest.TestCase):
                 pd.DataFrame(['aa; bb; c_', 'aa; bb; dd ee'],
                              index=pd.Index(['feat1', 'feat2'], name='id'),
                              columns=['Taxon']))
-        obs = filter_seqs(seqs, taxonomy, include='c_')
+        obs = self.filter_seqs(seqs, taxonomy, include='c_')
         exp = pd.Series(['ACGT'], index=['feat1'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -859,7 +1540,7 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         # keep both features
-        obs = filter_seqs(seqs, taxonomy, include='bb')
+        obs = self.filter_seqs(seqs, taxonomy, include='bb')
         exp = pd.Series(['ACGT', 'ACCC'], index=['feat1', 'feat2'])
         obs.sort_values(inplace=True)
         exp.sort_values(inplace=True)
@@ -873,7 +1554,73 @@ class FilterSeqs(unittest.TestCase):
                              columns=['Taxon']))
 
         with self.assertRaisesRegex(ValueError, expected_regex='All.*feat2'):
-            filter_seqs(seqs, taxonomy, include='bb')
+            self.filter_seqs(seqs, taxonomy, include='bb')
+
+    def test_records_copied_verbatim(self):
+        sequences = DNAFASTAFormat()
+        with open(str(sequences), 'w') as fh:
+            fh.write('>feat1 first feature\nACGT\nACGT\n'
+                     '>feat2\nACCC\n'
+                     '>feat3 third feature\nGGGG\nTT\n')
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(['aa; bb; cc', 'aa; bb; dd ee', 'aa; ff'],
+                             index=pd.Index(['feat1', 'feat2', 'feat3'],
+                                            name='id'),
+                             columns=['Taxon']))
+
+        obs = filter_seqs(sequences, taxonomy, exclude='dd')
+        with open(str(obs)) as fh:
+            self.assertEqual(fh.read(),
+                             '>feat1 first feature\nACGT\nACGT\n'
+                             '>feat3 third feature\nGGGG\nTT\n')
+
+
+class CachedSearchIndexMixin:
+
+    # Repeats the filtering tests with terms answered from the persistent
+    # search index.
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher = mock.patch.dict(os.environ, {CACHE_DIR_ENV: cache_dir.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class FilterTableCachedSearchIndex(CachedSearchIndexMixin, FilterTable):
+
+    def test_warm_query_uses_search_index(self):
+        lineages = ['k__K; p__P%d; g__G%d; s__S%d' % (i % 4, i % 20, i)
+                    for i in range(100)]
+        ids = ['feat%d' % i for i in range(100)]
+        taxonomy = qiime2.Metadata(
+                pd.DataFrame(lineages, index=pd.Index(ids, name='id'),
+                             columns=['Taxon']))
+        table = biom.Table(np.ones((100, 1)), ids, ['S1'])
+        query = 'g__G3; OR g__G17;'
+
+        with mock.patch.dict(os.environ, {CACHE_DIR_ENV: ''}), \
+                mock.patch.object(LineageSearchIndex, 'candidates',
+                                  autospec=True,
+                                  side_effect=LineageSearchIndex.candidates
+                                  ) as candidates:
+            expected = filter_table(table, taxonomy, query=query)
+            candidates.assert_not_called()
+
+        filter_table(table, taxonomy, query=query)
+        with mock.patch.object(LineageSearchIndex, 'candidates',
+                               autospec=True,
+                               side_effect=LineageSearchIndex.candidates
+                               ) as candidates:
+            actual = filter_table(table, taxonomy, query=query)
+        self.assertEqual(candidates.call_count, 2)
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual.shape, (10, 1))
+
+
+class FilterSeqsCachedSearchIndex(CachedSearchIndexMixin, FilterSeqs):
+    pass
 
 
 class TestUsageExamples(TestPluginBase):
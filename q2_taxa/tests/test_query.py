@@ -0,0 +1,81 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+from q2_taxa._query import _evaluate_query, _parse_query
+
+
+class ParseQueryTests(unittest.TestCase):
+
+    def test_precedence(self):
+        self.assertEqual(
+            _parse_query('a OR b AND NOT c', 'contains'),
+            [('term', ('contains', 'a')), ('term', ('contains', 'b')),
+             ('term', ('contains', 'c')), ('NOT',), ('AND',), ('OR',)])
+        self.assertEqual(
+            _parse_query('(a OR b) AND c', 'contains'),
+            [('term', ('contains', 'a')), ('term', ('contains', 'b')),
+             ('OR',), ('term', ('contains', 'c')), ('AND',)])
+        self.assertEqual(
+            _parse_query('NOT NOT a', 'exact'),
+            [('term', ('exact', 'a')), ('NOT',), ('NOT',)])
+
+    def test_terms(self):
+        self.assertEqual(
+            _parse_query('rank:g__:Bacteroides AND regex:"^d__(A|B)" OR '
+                         '"p__Candidate division" OR "say \\"AND\\""',
+                         'contains'),
+            [('term', ('rank', 'g__:Bacteroides')),
+             ('term', ('regex', '^d__(A|B)')), ('AND',),
+             ('term', ('contains', 'p__Candidate division')), ('OR',),
+             ('term', ('contains', 'say "AND"')), ('OR',)])
+        # words that are not modes are not split on colons
+        self.assertEqual(_parse_query('g__:Bacteroides', 'rank'),
+                         [('term', ('rank', 'g__:Bacteroides'))])
+        self.assertEqual(_parse_query('"AND"', 'exact'),
+                         [('term', ('exact', 'AND'))])
+
+    def test_invalid(self):
+        for query, message in (('', 'empty'), ('   ', 'empty'),
+                               ('a AND', 'end of query'),
+                               ('(a OR b', 'closing parenthesis'),
+                               ('a b', "unexpected 'term'"),
+                               ('a OR )', "unexpected '\\)'"),
+                               ('NOT', 'end of query'),
+                               ('"a', 'unexpected')):
+            with self.assertRaisesRegex(ValueError, message):
+                _parse_query(query, 'contains')
+
+
+class EvaluateQueryTests(unittest.TestCase):
+
+    def test_evaluate(self):
+        masks = {'a': np.array([True, True, False, False]),
+                 'b': np.array([True, False, True, False]),
+                 'c': np.array([False, True, True, True])}
+        calls = []
+
+        def match(terms, mode):
+            calls.append((terms, mode))
+            return masks[terms[0]]
+
+        npt.assert_array_equal(
+            _evaluate_query(_parse_query('(a AND NOT b) OR (c AND b) OR a',
+                                         'exact'), match),
+            [True, True, True, False])
+        # every distinct term is matched once
+        self.assertEqual(sorted(calls), [(['a'], 'exact'), (['b'], 'exact'),
+                                         (['c'], 'exact')])
+
+
+if __name__ == '__main__':
+    unittest.main()
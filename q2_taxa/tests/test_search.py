@@ -0,0 +1,180 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import random
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+
+from q2_taxa._search import (LineageSearchIndex, _like_literals,
+                             _like_to_regex, _match_lineages, _match_ranks)
+from q2_taxa._taxonomy import TaxonomyIndex
+
+
+class MatchLineagesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.lineages = np.array(
+            ['k__Bacteria; p__Firmicutes', 'k__Bacteria; p__Bacteroidetes',
+             'k__Archaea; p__Euryarchaeota', 'k__Bacteria; p__50%_group',
+             'k__Bactéria'], dtype=object)
+
+    def test_like_literals(self):
+        self.assertEqual(_like_literals('%ab_c%%de\\%f\\_%'),
+                         ['ab', 'c', 'de%f_'])
+        self.assertEqual(_like_literals('%%'), [])
+
+    def test_like_to_regex(self):
+        self.assertEqual(_like_to_regex('%ab%'), 'ab')
+        self.assertEqual(_like_to_regex('a_b'), r'\Aa.b\Z')
+        self.assertEqual(_like_to_regex('%a\\_b\\%'), r'a_b%\Z')
+        self.assertEqual(_like_to_regex('%%a.'), r'a\.\Z')
+        self.assertIsNone(_like_to_regex('%a\\'))
+
+    def test_exact(self):
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['k__Bacteria; p__Firmicutes',
+                                            'k__bacteria; p__Bacteroidetes',
+                                            'Archaea'], 'exact'),
+            [True, False, False, False, False])
+
+    def test_contains(self):
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['firmicutes', 'Archaea'],
+                            'contains'),
+            [True, False, True, False, False])
+
+        # only ASCII letters are matched case-insensitively, as in SQL
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['BACTÉRIA'], 'contains'),
+            [False, False, False, False, False])
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['BACTéRIA'], 'contains'),
+            [False, False, False, False, True])
+
+        # % is a wildcard, and the escape character makes % and _ literal
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['Bacteria%Bacteroid'],
+                            'contains'),
+            [False, True, False, False, False])
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['50\\%\\_'], 'contains'),
+            [False, False, False, True, False])
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['p__E_ry'], 'contains'),
+            [False, False, True, False, False])
+
+    def test_regex(self):
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['^k__Archaea', r'p__\d+'],
+                            'regex'),
+            [False, False, True, True, False])
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['bacteria'], 'regex'),
+            [False, False, False, False, False])
+
+        with self.assertRaisesRegex(ValueError, "Invalid.*'p__\\['"):
+            _match_lineages(self.lineages, ['p__['], 'regex')
+
+    def test_regex_terms_matched_separately(self):
+        # inline flags apply to their own term only
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['(?i)archaea', 'Firm'], 'regex'),
+            [True, False, True, False, False])
+
+        # group numbers and names are scoped to their own term
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, [r'(x)\1', r'(_)\1B'], 'regex'),
+            [True, True, False, True, True])
+        npt.assert_array_equal(
+            _match_lineages(self.lineages,
+                            ['(?P<g>Firm)', '(?P<g>Eury)'], 'regex'),
+            [True, False, True, False, False])
+
+    def test_contains_no_patterns(self):
+        npt.assert_array_equal(
+            _match_lineages(self.lineages, ['Bacteria\\'], 'contains'),
+            [False, False, False, False, False])
+
+
+class MatchRanksTests(unittest.TestCase):
+
+    def setUp(self):
+        self.taxonomy = TaxonomyIndex.from_series(pd.Series(
+            ['k__Bacteria; p__Bacteroidetes; g__Bacteroides',
+             'k__Bacteria; p__Bacteroidetes; g__Bacteroidales',
+             'k__Bacteria; p__Firmicutes',
+             'k__Bacteria; p__Bacteroidetes; g__Bacteroides'],
+            index=['feat1', 'feat2', 'feat3', 'feat4']))
+
+    def test_rank_prefix(self):
+        npt.assert_array_equal(
+            _match_ranks(self.taxonomy, ['g__:Bacteroides']),
+            [True, False, False])
+        npt.assert_array_equal(
+            _match_ranks(self.taxonomy, ['g__:Bacteroides', 'p__:Firmicutes',
+                                         'p__:Proteobacteria']),
+            [True, False, True])
+        npt.assert_array_equal(
+            _match_ranks(self.taxonomy, ['g__:bacteroides']),
+            [False, False, False])
+
+    def test_level(self):
+        npt.assert_array_equal(
+            _match_ranks(self.taxonomy, ['2:p__Firmicutes']),
+            [False, False, True])
+        npt.assert_array_equal(
+            _match_ranks(self.taxonomy, ['1:p__Firmicutes', '42:k__Bacteria']),
+            [False, False, False])
+        # ranks missing from a lineage are padded
+        npt.assert_array_equal(
+            _match_ranks(self.taxonomy, ['3:__']),
+            [False, False, True])
+
+    def test_invalid_terms(self):
+        with self.assertRaisesRegex(ValueError, '<rank>:<name>'):
+            _match_ranks(self.taxonomy, ['Bacteroides'])
+
+        with self.assertRaisesRegex(ValueError, 'of 0 is too low'):
+            _match_ranks(self.taxonomy, ['0:k__Bacteria'])
+
+
+class LineageSearchIndexTests(unittest.TestCase):
+
+    def test_trigrams(self):
+        index = LineageSearchIndex.from_lineages(['aBcd', 'bcd', 'ab', 'BCX'])
+
+        self.assertEqual(len(index.trigrams), 3)
+        npt.assert_array_equal(index.candidates('%bcd%'), [0, 1])
+        npt.assert_array_equal(index.candidates('%ABC%'), [0])
+        npt.assert_array_equal(index.candidates('%bc_%'), [])
+        npt.assert_array_equal(index.candidates('%zzz%'), [])
+        self.assertIsNone(index.candidates('%bc%'))
+
+    def test_match_equals_scan(self):
+        alphabet = list('abAB_%\\; \u00e9\u00c9.*[')
+        rng = random.Random(0)
+        lineages = sorted({''.join(rng.choice(alphabet)
+                                   for _ in range(rng.randint(0, 10)))
+                           for _ in range(500)})
+        index = LineageSearchIndex.from_lineages(lineages)
+
+        for _ in range(500):
+            terms = [''.join(rng.choice(alphabet)
+                             for _ in range(rng.randint(0, 5)))
+                     for _ in range(rng.randint(1, 3))]
+            for mode in ('exact', 'contains'):
+                npt.assert_array_equal(
+                    index.match(terms, mode),
+                    _match_lineages(lineages, terms, mode))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+
+from q2_taxa._taxonomy import TaxonomyIndex
+
+
+class TaxonomyIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.taxonomy = pd.Series(['a; b; c', 'a; d', 'a; b; c', 'e;f; g '],
+                                  index=['feat1', 'feat2', 'feat3', 'feat4'])
+
+    def test_from_series(self):
+        index = TaxonomyIndex.from_series(self.taxonomy)
+
+        self.assertEqual(len(index), 4)
+        npt.assert_array_equal(index.lineages,
+                               ['a; b; c', 'a; d', 'e;f; g '])
+        npt.assert_array_equal(index.lineage_codes, [0, 1, 0, 2])
+
+    def test_ranks(self):
+        index = TaxonomyIndex.from_series(self.taxonomy)
+
+        self.assertEqual(index.max_level, 3)
+        npt.assert_array_equal(index.depths, [3, 2, 3])
+        npt.assert_array_equal(index.vocabularies[0], ['a', 'e'])
+        npt.assert_array_equal(index.vocabularies[2], ['c', '__', 'g'])
+        npt.assert_array_equal(index.rank_codes(2), [0, 1, 0, 2])
+
+    def test_take(self):
+        index = TaxonomyIndex.from_series(self.taxonomy)
+        index.ranks
+
+        obs = index.take(index.get_indexer(['feat4', 'feat3']))
+
+        npt.assert_array_equal(obs.ids, ['feat4', 'feat3'])
+        npt.assert_array_equal(obs.lineages, ['e;f; g ', 'a; b; c'])
+        npt.assert_array_equal(obs.lineage_codes, [0, 1])
+        npt.assert_array_equal(obs.rank_codes(0), [1, 0])
+        self.assertEqual(obs.max_level, 3)
+
+    def test_get_indexer_sorted_ids(self):
+        ids = np.array(['feat%d' % i for i in range(100)])[::-1]
+        order = np.argsort(ids)
+        index = TaxonomyIndex(ids, np.zeros(100), ['a; b'],
+                              sorted_ids=ids[order], id_order=order)
+        plain = TaxonomyIndex(ids, np.zeros(100), ['a; b'])
+
+        # few IDs are looked up by binary search, and many through pandas
+        for queries in (['feat3', 'feat100', 'feat0', 'a', 'zz', 'feat99'],
+                        ['feat%d' % i for i in range(0, 200, 3)]):
+            npt.assert_array_equal(index.get_indexer(queries),
+                                   plain.get_indexer(queries))
+        npt.assert_array_equal(
+            index.get_indexer(['feat3', 'feat100', 'feat0', 'feat99']),
+            [96, -1, 99, 0])
+
+        empty = TaxonomyIndex(np.array([], dtype=str), [], [],
+                              sorted_ids=np.array([], dtype=str),
+                              id_order=np.array([], dtype=np.intp))
+        npt.assert_array_equal(empty.get_indexer(['feat1']), [-1])
+
+    def test_groups(self):
+        index = TaxonomyIndex.from_series(self.taxonomy)
+
+        codes, labels = index.groups(1)
+        npt.assert_array_equal(codes, [0, 0, 0, 1])
+        npt.assert_array_equal(labels, ['a', 'e'])
+
+        codes, labels = index.groups(3)
+        npt.assert_array_equal(codes, [0, 1, 0, 2])
+        npt.assert_array_equal(labels, ['a;b;c', 'a;d;__', 'e;f;g'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import tracemalloc
+import unittest
+
+import biom
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import scipy.sparse
+
+from q2_taxa._taxonomy import TaxonomyIndex
+from q2_taxa._util import (_accumulator_dtype, _biom_to_df,
+                           _collapse_presence_absence_table, _collapse_table,
+                           _compact_dtype, _extract_to_level, _group_blocks,
+                           _grouped_sum, _indicator_matrix)
+
+
+class CollapseTableTests(unittest.TestCase):
+
+    def test_collapse_table_does_not_copy_input(self):
+        n_features, n_samples = 5000, 200
+        data = scipy.sparse.random(n_features, n_samples, density=0.2,
+                                   format='csr', random_state=0)
+        table = biom.Table(data, ['feat%d' % i for i in range(n_features)],
+                           ['S%d' % i for i in range(n_samples)])
+        taxonomy = TaxonomyIndex.from_series(
+            pd.Series(['a; b; c%d' % (i % 10) for i in range(n_features)],
+                      index=table.ids(axis='observation')))
+        taxonomy.ranks
+        matrix = table.matrix_data
+        input_size = (matrix.data.nbytes + matrix.indices.nbytes +
+                      matrix.indptr.nbytes)
+        before = table.copy()
+
+        tracemalloc.start()
+        try:
+            collapsed = _collapse_table(table, taxonomy, 3)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # a full copy of the input matrix alone would exceed input_size; the
+        # collapsed table here has only 10 features.
+        self.assertEqual(collapsed.shape, (10, n_samples))
+        self.assertLess(peak, 0.5 * input_size)
+        self.assertEqual(table, before)
+
+
+class GroupedSumTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = scipy.sparse.random(500, 40, density=0.3, format='csr',
+                                          random_state=0)
+        # groups of very different sizes, and a feature in no group
+        group_codes = np.minimum(
+            np.random.RandomState(0).geometric(0.05, size=500) - 1, 30)
+        group_codes[7] = -1
+        self.indicator = _indicator_matrix(group_codes, 31, np.float64)
+
+    def test_group_blocks(self):
+        for n_blocks in (1, 2, 3, 8, 31, 100):
+            bounds = _group_blocks(self.indicator, n_blocks)
+            self.assertEqual(bounds[0][0], 0)
+            self.assertEqual(bounds[-1][1], 31)
+            self.assertLessEqual(len(bounds), n_blocks)
+            for (_, stop), (start, _) in zip(bounds[:-1], bounds[1:]):
+                self.assertEqual(stop, start)
+
+    def test_n_jobs_bit_identical(self):
+        expected = _grouped_sum(self.indicator, self.matrix)
+        for n_jobs in (2, 3, 8, 100):
+            actual = _grouped_sum(self.indicator, self.matrix, n_jobs)
+            self.assertEqual(actual.shape, expected.shape)
+            np.testing.assert_array_equal(actual.toarray(),
+                                          expected.toarray())
+
+
+class CollapsePresenceAbsenceTableTests(unittest.TestCase):
+
+    def test_explicit_zeros(self):
+        data = scipy.sparse.csr_matrix(np.array([[1.0, 0.0, 1.0],
+                                                 [0.0, 1.0, 0.0],
+                                                 [1.0, 0.0, 0.0]]))
+        data.data[[1, 2]] = 0.0
+        table = biom.Table(data, ['feat1', 'feat2', 'feat3'],
+                           ['A', 'B', 'C'])
+        taxonomy = TaxonomyIndex.from_series(
+            pd.Series(['a; b', 'c; d', 'a; e'],
+                      index=table.ids(axis='observation')))
+
+        actual = _collapse_presence_absence_table(table, taxonomy, 1)
+        self.assertEqual(actual.matrix_data.nnz, 1)
+        np.testing.assert_array_equal(actual.matrix_data.toarray(),
+                                      [[1.0, 0.0, 0.0], [0.0, 0.0, 0.0]])
+        # the values are an array of their own, which can be modified
+        self.assertTrue(actual.matrix_data.data.flags.writeable)
+
+    def test_less_memory_than_float_collapse(self):
+        n_features, n_samples = 20000, 500
+        data = scipy.sparse.random(n_features, n_samples, density=0.05,
+                                   format='csr', random_state=0)
+        data.data[:] = 1.0
+        table = biom.Table(data, ['feat%d' % i for i in range(n_features)],
+                           ['S%d' % i for i in range(n_samples)])
+        taxonomy = TaxonomyIndex.from_series(
+            pd.Series(['a%d; b%d' % (i % 50, i % 5000)
+                       for i in range(n_features)],
+                      index=table.ids(axis='observation')))
+        taxonomy.ranks
+
+        def _peak(collapse):
+            tracemalloc.start()
+            try:
+                collapsed = collapse(table, taxonomy, 2)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            return collapsed, peak
+
+        expected, float_peak = _peak(_collapse_table)
+        actual, peak = _peak(_collapse_presence_absence_table)
+        self.assertEqual(actual, expected.pa(inplace=False))
+        self.assertLess(peak, 0.8 * float_peak)
+
+
+class DtypeTests(unittest.TestCase):
+
+    def test_accumulator_dtype(self):
+        self.assertEqual(_accumulator_dtype(np.int32), np.int64)
+        self.assertEqual(_accumulator_dtype(np.uint16), np.int64)
+        self.assertEqual(_accumulator_dtype(np.float64), np.float64)
+        self.assertEqual(_accumulator_dtype(np.float32), np.float32)
+
+    def test_compact_dtype(self):
+        self.assertEqual(_compact_dtype(np.array([0.0, 3.0, 2.0 ** 32 - 1])),
+                         np.uint32)
+        self.assertEqual(_compact_dtype(np.array([-1.0, 3.0])), np.int32)
+        self.assertEqual(_compact_dtype(np.array([2.0 ** 32])), np.int64)
+        self.assertEqual(_compact_dtype(np.array([], dtype=float)),
+                         np.uint32)
+        self.assertEqual(_compact_dtype(np.array([0.5, 3.0])), np.float64)
+        self.assertEqual(_compact_dtype(np.array([np.nan, 3.0])), np.float64)
+        self.assertEqual(_compact_dtype(np.array([2.0 ** 70])), np.float64)
+        self.assertEqual(_compact_dtype(np.array([7], dtype=np.int64)),
+                         np.uint32)
+
+    def test_biom_to_df(self):
+        table = biom.Table(np.array([[2.0, 0.0], [1.0, 5.0]]),
+                           ['feat1', 'feat2'], ['A', 'B'])
+        pdt.assert_frame_equal(
+            _biom_to_df(table),
+            pd.DataFrame([[2, 1], [0, 5]], index=['A', 'B'],
+                         columns=['feat1', 'feat2'], dtype=np.uint32))
+
+        table = biom.Table(np.array([[0.5, 0.0], [0.5, 1.0]]),
+                           ['feat1', 'feat2'], ['A', 'B'])
+        pdt.assert_frame_equal(
+            _biom_to_df(table),
+            pd.DataFrame([[0.5, 0.5], [0.0, 1.0]], index=['A', 'B'],
+                         columns=['feat1', 'feat2']))
+
+
+class ExtractToLevelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.table = biom.Table(np.array([[2.0, 0.0, 1.0],
+                                          [1.0, 1.0, 0.0],
+                                          [9.0, 8.0, 3.0],
+                                          [0.0, 4.0, 5.0]]),
+                                ['feat1', 'feat2', 'feat3', 'feat4'],
+                                ['A', 'B', 'C'])
+        self.taxonomy = TaxonomyIndex.from_series(
+            pd.Series(['a; b; c', 'a; d', 'e; f; g', 'a; b; h'],
+                      index=['feat1', 'feat2', 'feat3', 'feat4']))
+
+    def test_extract_to_level(self):
+        actual = _extract_to_level(self.taxonomy, self.table)
+
+        self.assertEqual(len(actual), 3)
+        pdt.assert_frame_equal(
+            actual[0],
+            pd.DataFrame([[3, 9], [5, 8], [6, 3]],
+                         index=['A', 'B', 'C'], columns=['a', 'e'],
+                         dtype=np.uint32))
+        pdt.assert_frame_equal(
+            actual[1],
+            pd.DataFrame([[2, 1, 9], [4, 1, 8], [6, 0, 3]],
+                         index=['A', 'B', 'C'], columns=['a;b', 'a;d', 'e;f'],
+                         dtype=np.uint32))
+
+    def test_extract_to_level_matches_collapse(self):
+        actual = _extract_to_level(self.taxonomy, self.table)
+
+        for level, df in enumerate(actual, 1):
+            expected = _biom_to_df(
+                _collapse_table(self.table, self.taxonomy, level))
+            pdt.assert_frame_equal(df, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()